@@ -0,0 +1,2161 @@
+#!/usr/bin/env python3
+
+# Avvie image engine: crop, transform, preview and export without GTK.
+# main.py is the window on top of this.
+
+# Copyright 2019 Taiko2k captain(dot)gxj(at)gmail.com
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import math
+import subprocess
+import shutil
+import json
+import glob
+import argparse
+import multiprocessing
+import threading
+import queue
+import copy
+import hashlib
+import time
+import atexit
+import functools
+import contextlib
+import zlib
+import struct
+import io
+import cairo
+from PIL import Image
+
+# Optional, speeds up the preview filters. It takes a while to import, so that's left
+# until the first preview needs it.
+numpy = None
+numpy_checked = False
+
+
+def have_numpy():
+
+    global numpy, numpy_checked
+    if not numpy_checked:
+        numpy_checked = True
+        try:
+            import numpy
+        except ImportError:
+            pass
+    return numpy is not None
+
+def point_in_rect(rx, ry, rw, rh, px, py):
+    return ry < py < ry + rh and rx < px < rx + rw
+
+# Get distance between two points (pythagoras)
+def point_prox(x1, y1, x2, y2):
+    return math.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
+
+# Get the output to input matrix Image.rotate(angle, expand=True) would use, and the output size
+def rotation_matrix(w, h, angle):
+
+    # Same steps as PIL so the rounding matches
+    angle = -math.radians(angle % 360.0)
+    a = round(math.cos(angle), 15)
+    b = round(math.sin(angle), 15)
+    c = a * -(w / 2.0) + b * -(h / 2.0) + w / 2.0
+    f = -b * -(w / 2.0) + a * -(h / 2.0) + h / 2.0
+
+    xx = []
+    yy = []
+    for x, y in ((0, 0), (w, 0), (w, h), (0, h)):
+        xx.append(a * x + b * y + c)
+        yy.append(-b * x + a * y + f)
+
+    nw = math.ceil(max(xx)) - math.floor(min(xx))
+    nh = math.ceil(max(yy)) - math.floor(min(yy))
+
+    # Shift so the expanded output stays centered
+    x = -(nw - w) / 2.0
+    y = -(nh - h) / 2.0
+    return (a, b, a * x + b * y + c, -b, a, -b * x + a * y + f), (nw, nh)
+
+
+# Get size of image after Image.rotate(angle, expand=True) without doing the rotation
+def rotated_size(w, h, angle):
+    if not angle:
+        return w, h
+    return rotation_matrix(w, h, angle)[1]
+
+
+# Get size of image after Image.thumbnail((max_w, max_h))
+def fit_size(w, h, max_w, max_h):
+    if w <= max_w and h <= max_h:
+        return w, h
+
+    aspect = w / h
+    if max_w / max_h >= aspect:
+        return max(round(max_h * aspect), 1), max_h
+    return max_w, max(round(max_w / aspect), 1)
+
+
+# Convert image to a mode that can be reduced, rotated and shown on a cairo surface
+def display_mode(image):
+
+    if image.mode in ("RGB", "RGBA", "L", "LA"):
+        image.load()
+        return image
+    if "A" in image.getbands() or "transparency" in image.info:
+        return image.convert("RGBA")
+    return image.convert("RGB")
+
+
+class TraceSpan:
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.tracer.add(self.name, self.start, time.perf_counter())
+
+
+class Tracer:
+
+    # Opt-in timing of the expensive stages. Set AVVIE_TRACE (or "trace-file" in the
+    # app config) to a file name and the spans and cache counters are written there on
+    # exit, in the Chrome trace format that chrome://tracing and Perfetto open.
+    # AVVIE_TRACE_OVERLAY=1 also draws frame and draw times on the canvas.
+
+    def __init__(self, path=None, overlay=False):
+
+        self.path = None
+        self.enabled = False
+        self.overlay = overlay
+        self.events = []
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+
+        if path:
+            self.enable(path)
+
+    def enable(self, path):
+
+        if not self.enabled:
+            atexit.register(self.save)
+        self.path = path
+        self.enabled = True
+
+    def span(self, name):
+
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return TraceSpan(self, name)
+
+    def timed(self, name):
+
+        # Decorator version of span
+        def decorate(function):
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with TraceSpan(self, name):
+                    return function(*args, **kwargs)
+            return wrapper
+
+        return decorate
+
+    def add(self, name, start, end):
+
+        with self.lock:
+            self.events.append({
+                "name": name, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                "ts": (start - self.start) * 1000000, "dur": (end - start) * 1000000,
+            })
+
+    def count(self, name, hit):
+
+        if not self.enabled:
+            return
+
+        with self.lock:
+            counter = self.counters.setdefault(name, {"hits": 0, "misses": 0})
+            counter["hits" if hit else "misses"] += 1
+            self.events.append({
+                "name": name, "ph": "C", "pid": os.getpid(),
+                "ts": (time.perf_counter() - self.start) * 1000000, "args": dict(counter),
+            })
+
+    def save(self):
+
+        with self.lock:
+            events = list(self.events)
+            counters = dict(self.counters)
+
+        try:
+            with open(self.path, "w") as f:
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        except OSError as e:
+            print(f"Failed to write trace: {e}")
+            return
+
+        print(f"Trace written to {self.path}")
+        for name, counter in counters.items():
+            print(f"{name}: {counter['hits']} hits, {counter['misses']} misses")
+
+
+tracer = Tracer(os.environ.get("AVVIE_TRACE"), os.environ.get("AVVIE_TRACE_OVERLAY") == "1")
+
+
+class SurfacePool:
+
+    # Keeps cairo surfaces that have been replaced so the next surface of the same
+    # format and size can reuse the buffer instead of allocating another one
+
+    def __init__(self, limit=4):
+
+        self.limit = limit
+        self.free = {}
+
+        # Number of surfaces actually created, for benchmarking
+        self.allocations = 0
+
+    def acquire(self, format, w, h):
+
+        surfaces = self.free.get((format, w, h))
+        tracer.count("surface_pool", bool(surfaces))
+        if surfaces:
+            return surfaces.pop()
+
+        self.allocations += 1
+        return cairo.ImageSurface(format, w, h)
+
+    def release(self, surface):
+
+        if surface is None:
+            return
+
+        surfaces = self.free.setdefault((surface.get_format(), surface.get_width(), surface.get_height()), [])
+        if len(surfaces) < self.limit:
+            surfaces.append(surface)
+
+    @tracer.timed("convert")
+    def convert(self, im, old=None):
+
+        # Opaque images go to RGB24 surfaces so no alpha channel has to be added first
+        if im.mode == "RGBA":
+            format, rawmode = cairo.FORMAT_ARGB32, "BGRa"
+        else:
+            if im.mode != "RGB":
+                im = im.convert("RGB")
+            format, rawmode = cairo.FORMAT_RGB24, "BGRX"
+
+        # The surface being replaced can be reused right away
+        self.release(old)
+        surface = self.acquire(format, im.width, im.height)
+        surface.flush()
+
+        # Encode the rows at the surface's stride straight into its buffer, a chunk at
+        # a time, rather than building the whole image as bytes and copying that
+        stride = surface.get_stride()
+        data = surface.get_data()
+        im.load()
+        encoder = Image._getencoder(im.mode, "raw", (rawmode, stride))
+        encoder.setimage(im.im, (0, 0) + im.size)
+        bufsize = max(65536, stride)
+
+        offset = 0
+        while True:
+            consumed, errcode, chunk = encoder.encode(bufsize)
+            data[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+            if errcode:
+                break
+
+        if errcode < 0:
+            raise RuntimeError(f"encoder error {errcode} converting to surface")
+
+        surface.mark_dirty()
+        return surface
+
+    @tracer.timed("convert_filtered")
+    def convert_filtered(self, im, old=None, gray=False, flips=(False, False)):
+
+        # NumPy version of the preview filters. Gray and flips work on one float array
+        # and the result is written as BGRA straight into a pooled surface. Sharpening
+        # is left to apply_filters, the preview has to match the export exactly.
+        if im.mode not in ("RGB", "RGBA"):
+            im = im.convert("RGBA" if "A" in im.getbands() else "RGB")
+
+        a = numpy.asarray(im)
+        if flips[0]:
+            a = a[:, ::-1]
+        if flips[1]:
+            a = a[::-1]
+
+        rgb = a[..., :3].astype(numpy.float32)
+
+        if gray:
+            # Same weights as convert("L")
+            rgb[...] = (rgb @ numpy.array((0.299, 0.587, 0.114), numpy.float32))[..., None]
+
+        numpy.clip(rgb, 0, 255, out=rgb)
+
+        if im.mode == "RGBA":
+            # Cairo wants premultiplied alpha
+            alpha = a[..., 3]
+            rgb *= alpha[..., None] / numpy.float32(255)
+            format = cairo.FORMAT_ARGB32
+        else:
+            alpha = 255
+            format = cairo.FORMAT_RGB24
+
+        rgb += 0.5
+
+        self.release(old)
+        surface = self.acquire(format, im.width, im.height)
+        surface.flush()
+
+        stride = surface.get_stride()
+        out = numpy.ndarray((im.height, stride // 4, 4), numpy.uint8, surface.get_data())[:, :im.width]
+        out[..., 0] = rgb[..., 2]
+        out[..., 1] = rgb[..., 1]
+        out[..., 2] = rgb[..., 0]
+        out[..., 3] = alpha
+
+        surface.mark_dirty()
+        return surface
+
+
+class ProxyCache:
+
+    # Pyramid levels saved to disk so reopening an image skips decoding it. Files are
+    # named by a hash of the source path, mtime, file size and level, and the least
+    # recently used ones are deleted once the folder grows past the size limit. Levels
+    # are stored losslessly, exports and HQ previews read them too and have to come out
+    # the same whether the cache was warm or not.
+
+    # Larger levels aren't display proxies and would only fill the cache
+    max_size = 4096
+
+    def __init__(self, folder, limit):
+
+        self.folder = folder
+        self.limit = limit
+        self.queue = None
+        self.lock = threading.Lock()
+
+    def key(self, path):
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        text = f"{os.path.abspath(path)}\0{st.st_mtime_ns}\0{st.st_size}"
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def get(self, key, level):
+
+        file = os.path.join(self.folder, f"{key}-{level}.png")
+        try:
+            im = Image.open(file)
+            im.load()
+        except (OSError, ValueError):
+            return None
+
+        # Touch it so it counts as recently used
+        try:
+            os.utime(file)
+        except OSError:
+            pass
+        return im
+
+    def put(self, key, level, im):
+
+        # Saving is done on the writer thread so it never holds up loading or drawing
+        if max(im.size) > self.max_size:
+            return
+
+        # The writer is started by the first put, which can come from the loader, the
+        # prefetcher and exports at once
+        with self.lock:
+            if self.queue is None:
+                self.queue = queue.Queue()
+                thread = threading.Thread(target=self.writer)
+                thread.daemon = True
+                thread.start()
+
+        self.queue.put((key, level, im))
+
+    def writer(self):
+
+        while True:
+            key, level, im = self.queue.get()
+            try:
+                if not os.path.isdir(self.folder):
+                    os.makedirs(self.folder)
+
+                file = os.path.join(self.folder, f"{key}-{level}.png")
+                im.save(file + ".tmp", "PNG", compress_level=1)
+                os.replace(file + ".tmp", file)
+
+                self.trim()
+            except OSError as e:
+                print(f"Failed to write proxy cache: {e}")
+
+    def trim(self):
+
+        entries = []
+        total = 0
+        for entry in os.scandir(self.folder):
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+
+        entries.sort()
+        while total > self.limit and entries:
+            mtime, size, file = entries.pop(0)
+            try:
+                os.remove(file)
+            except OSError:
+                continue
+            total -= size
+
+
+class PNGBands:
+
+    # Reads rows of a PNG without decoding the rest of it. The image data is inflated as
+    # it's needed and each run of rows is unfiltered by PIL as a small PNG of its own,
+    # led by the row above it so the filters that look up still work. The inflater is
+    # copied every so often so later reads can start close to where they're needed.
+    # Only non-interlaced 8 bit images, for other depths PIL doesn't hand back the raw rows.
+
+    signature = b"\x89PNG\r\n\x1a\n"
+    channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+    checkpoint_rows = 256
+
+    def __init__(self, path):
+
+        self.path = path
+        self.header = None
+        self.palette = []
+        self.chunks = []
+
+        with open(path, "rb") as f:
+            if f.read(8) != self.signature:
+                raise ValueError("not a PNG")
+            while True:
+                head = f.read(8)
+                if len(head) < 8:
+                    break
+                length, kind = struct.unpack(">I4s", head)
+                if kind == b"IDAT":
+                    self.chunks.append((f.tell(), length))
+                    f.seek(length + 4, 1)
+                elif kind == b"IEND":
+                    break
+                else:
+                    data = f.read(length)
+                    f.seek(4, 1)
+                    if kind == b"IHDR":
+                        self.header = data
+                    elif kind in (b"PLTE", b"tRNS"):
+                        self.palette.append((kind, data))
+
+        w, h, depth, color, compression, filter, interlace = struct.unpack(">IIBBBBB", self.header)
+        if depth != 8 or interlace or color not in self.channels:
+            raise ValueError("only non-interlaced 8 bit PNGs can be read in bands")
+
+        self.size = (w, h)
+        self.stride = w * self.channels[color]
+
+        # Row to (IDAT index, offset in it, inflater, unused output, row above)
+        self.checkpoints = {0: (0, 0, zlib.decompressobj(), b"", bytes(self.stride))}
+
+    def chunk(self, kind, data):
+
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    def unfilter(self, above, data, n):
+
+        # n filtered rows as a PNG that PIL can decode, the row above goes first unfiltered
+        header = struct.pack(">II", self.size[0], n + 1) + self.header[8:]
+        png = [self.signature, self.chunk(b"IHDR", header)]
+        png.extend(self.chunk(kind, data) for kind, data in self.palette)
+        png.append(self.chunk(b"IDAT", zlib.compress(b"\0" + above + data, 0)))
+        png.append(self.chunk(b"IEND", b""))
+
+        im = Image.open(io.BytesIO(b"".join(png)))
+        im.load()
+        return im
+
+    def read(self, box):
+
+        x0, y0, x1, y1 = box
+        w = self.size[0]
+        row = self.stride + 1
+
+        # Runs of rows are decoded together, about a MB at a time
+        run = max(min(self.checkpoint_rows, (1 << 20) // row), 1)
+
+        y = max(y for y in self.checkpoints if y <= y0)
+        index, offset, inflater, pending, above = self.checkpoints[y]
+        inflater = inflater.copy()
+
+        band = None
+        with open(self.path, "rb") as f:
+            while y < y1:
+                n = min(run, y1 - y, self.checkpoint_rows - y % self.checkpoint_rows)
+                need = n * row
+
+                data = [pending]
+                got = len(pending)
+                while got < need:
+                    if inflater.unconsumed_tail:
+                        out = inflater.decompress(inflater.unconsumed_tail, need - got)
+                    elif index < len(self.chunks):
+                        start, length = self.chunks[index]
+                        f.seek(start + offset)
+                        piece = f.read(min(length - offset, 1 << 16))
+                        offset += len(piece)
+                        if offset >= length:
+                            index += 1
+                            offset = 0
+                        out = inflater.decompress(piece, need - got)
+                    else:
+                        raise ValueError("PNG image data ends early")
+                    data.append(out)
+                    got += len(out)
+
+                data = b"".join(data)
+                pending = data[need:]
+
+                im = self.unfilter(above, data[:need], n)
+                above = im.crop((0, n, w, n + 1)).tobytes()
+
+                if y + n > y0:
+                    part = im.crop((x0, max(y0 - y, 0) + 1, x1, n + 1))
+                    if band is None:
+                        band = part if y + n >= y1 else Image.new(part.mode, (x1 - x0, y1 - y0))
+                        if part.mode == "P":
+                            band.putpalette(im.getpalette())
+                        band.info = dict(im.info)
+                    if band is not part:
+                        band.paste(part, (0, max(y, y0) - y0))
+
+                y += n
+                if y % self.checkpoint_rows == 0 and y not in self.checkpoints:
+                    self.checkpoints[y] = (index, offset, inflater.copy(), pending, above)
+
+        return band
+
+
+class JPEGBands:
+
+    # Reads regions of a JPEG with djpeg -crop, which skips the rows above the region
+    # and stops after it. Progressive files still have to be read through whole.
+
+    def __init__(self, path, size):
+
+        self.path = path
+        self.size = size
+
+    def read(self, box):
+
+        x0, y0, x1, y1 = box
+        w = x1 - x0
+        result = subprocess.run(
+            ["djpeg", "-pnm", "-crop", f"{w}x{y1 - y0}+{x0}+{y0}", self.path],
+            check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        im = Image.open(io.BytesIO(result.stdout))
+        im.load()
+
+        # The left edge is moved back onto the MCU grid and the width grows to match
+        dx = im.width - w
+        return im.crop((dx, 0, dx + w, y1 - y0))
+
+
+def open_bands(image, path):
+
+    # A reader for parts of the image, or None if it can only be decoded whole
+    try:
+        if image.format == "PNG":
+            return PNGBands(path)
+        if image.format == "JPEG" and image.mode in ("RGB", "L") and shutil.which("djpeg"):
+            return JPEGBands(path, image.size)
+    except (OSError, ValueError, struct.error) as e:
+        print(f"Can't read {path} in bands: {e}")
+    return None
+
+
+class ImagePyramid:
+
+    # Stop halving once the short side would go below this
+    min_size = 64
+
+    # JPEG can decode straight to 1/2, 1/4 and 1/8 scale
+    max_draft_level = 3
+
+    # Bytes a decoded level may take, None for no limit. Levels over it are built from
+    # bands of the source and exports from them are done in tiles. Set from the config
+    # or --memory-limit.
+    memory_limit = None
+
+    def __init__(self, image, path=None, cache=None):
+
+        self.image = image
+        self.path = path
+
+        self.cache = cache
+        self.cache_key = None
+        if cache is not None and path:
+            self.cache_key = cache.key(path)
+
+        # Level n is the source reduced by 2^n. Only the header has been read so far,
+        # levels are decoded when first asked for.
+        w, h = image.size
+        self.sizes = [(w, h)]
+        while min(w, h) // 2 >= self.min_size:
+            w, h = (w + 1) // 2, (h + 1) // 2
+            self.sizes.append((w, h))
+
+        self.levels = [None] * len(self.sizes)
+
+        # Levels may be decoded from a loading thread while the window is using them.
+        # The lock only guards which thread decodes what, decoding happens outside it
+        # so a level that's ready never waits behind one that isn't.
+        self.lock = threading.Lock()
+        self.decoding = {}
+        self.source_lock = threading.Lock()
+
+    def level_for(self, w, h):
+
+        # Find the smallest level that still covers w x h pixels, or the largest within
+        # the memory limit
+        for i in range(len(self.sizes) - 1, 0, -1):
+            lw, lh = self.sizes[i]
+            if lw >= w and lh >= h:
+                return max(i, self.hq_level())
+        return self.hq_level()
+
+    def fits(self, level):
+
+        if self.memory_limit is None:
+            return True
+        w, h = self.sizes[level]
+        return w * h * 4 <= self.memory_limit
+
+    def hq_level(self):
+
+        # The largest level within the memory limit
+        for i in range(len(self.sizes)):
+            if self.fits(i):
+                return i
+        return len(self.sizes) - 1
+
+    def decoded_level(self, level):
+
+        # Find the closest level to this one that is already decoded, preferring larger ones
+        for i in list(range(level, -1, -1)) + list(range(level + 1, len(self.levels))):
+            if self.levels[i] is not None:
+                return i
+        return level
+
+    def source(self):
+
+        # The untouched source image, fully decoded
+        with self.source_lock:
+            self.image.load()
+            return self.image
+
+    def get(self, level):
+
+        im = self.levels[level]
+        if im is not None:
+            return im
+
+        # One thread decodes each level, any others asking for it wait for that
+        with self.lock:
+            if self.levels[level] is not None:
+                return self.levels[level]
+            event = self.decoding.get(level)
+            owner = event is None
+            if owner:
+                event = self.decoding[level] = threading.Event()
+
+        if not owner:
+            event.wait()
+            if self.levels[level] is not None:
+                return self.levels[level]
+            # The decoding thread failed, try again here
+            return self.get(level)
+
+        try:
+            im = self.decode(level)
+            with self.lock:
+                self.levels[level] = im
+        finally:
+            with self.lock:
+                del self.decoding[level]
+            event.set()
+
+        return im
+
+    def decode(self, level):
+
+        if level == 0:
+            with tracer.span("decode"):
+                return display_mode(self.source())
+
+        if self.cache_key is not None:
+            im = self.cache.get(self.cache_key, level)
+            tracer.count("proxy_cache", im is not None)
+            if im is not None:
+                return im
+
+        if self.levels[level - 1] is not None or self.levels[0] is not None or \
+                level > self.max_draft_level or not self.path:
+            im = self.get(level - 1).reduce(2)
+        else:
+            im = self.decode_reduced(level)
+
+        if self.cache_key is not None:
+            self.cache.put(self.cache_key, level, im)
+
+        return im
+
+    @tracer.timed("decode_reduced")
+    def decode_reduced(self, level):
+
+        w, h = self.sizes[0]
+        im = Image.open(self.path)
+
+        if im.format not in ("JPEG", "JPEG2000") and not self.fits(0):
+            bands = open_bands(im, self.path)
+            if bands is not None:
+                return self.decode_bands(bands, level)
+
+        if im.format == "JPEG2000":
+            im.reduce = level
+        else:
+            # Ask for slightly less than the level size so the decoder picks the 1/2^n scale
+            im.draft(im.mode, (max(w >> level, 1), max(h >> level, 1)))
+
+        im = display_mode(im)
+
+        # Formats without reduced decoding hand back the full image
+        if im.size == self.sizes[0]:
+            with self.lock:
+                if self.levels[0] is None:
+                    self.levels[0] = im
+            return self.get(level - 1).reduce(2)
+
+        return im
+
+    def decode_bands(self, bands, level):
+
+        # Reduce the source a band at a time. Bands are a whole number of 2^level rows
+        # so the result is the same as reducing the full image.
+        factor = 2 ** level
+        w, h = self.sizes[0]
+        rows = max(self.memory_limit // (w * 4 * 3) // factor, 1) * factor
+
+        out = None
+        for y in range(0, h, rows):
+            band = display_mode(bands.read((0, y, w, min(y + rows, h)))).reduce(factor)
+            if out is None:
+                out = Image.new(band.mode, self.sizes[level])
+            out.paste(band, (0, y // factor))
+        return out
+
+
+class ExportPlan:
+
+    # Margin of source pixels kept around the region for the bicubic filter
+    margin = 3
+
+    def __init__(self, source_size, rotation, flip_hoz, flip_vert, box, out_size):
+
+        # Work out where each output pixel comes from in the source by going back
+        # through the scale, the crop, the rotation and then the flips
+        w, h = source_size
+        (a, b, c, d, e, f), rotated = rotation_matrix(w, h, rotation)
+
+        x0, y0, x1, y1 = box
+        ow, oh = out_size
+        sx = (x1 - x0) / ow
+        sy = (y1 - y0) / oh
+
+        m = [a * sx, b * sy, a * x0 + b * y0 + c,
+             d * sx, e * sy, d * x0 + e * y0 + f]
+
+        if flip_hoz:
+            m[0], m[1], m[2] = -m[0], -m[1], w - m[2]
+        if flip_vert:
+            m[3], m[4], m[5] = -m[3], -m[4], h - m[5]
+
+        self.source_size = source_size
+        self.out_size = out_size
+        self.matrix = m
+        self.scale = min(sx, sy)
+        self.flip_hoz = flip_hoz
+        self.flip_vert = flip_vert
+        self.axis_aligned = not rotation % 360
+
+    def get_region(self, matrix, size, margin=None):
+
+        # Bounding box of the source pixels the output reads from
+        if margin is None:
+            margin = self.margin
+        a, b, c, d, e, f = matrix
+        ow, oh = self.out_size
+        xx = []
+        yy = []
+        for x, y in ((0, 0), (ow, 0), (ow, oh), (0, oh)):
+            xx.append(a * x + b * y + c)
+            yy.append(d * x + e * y + f)
+
+        # Tiles in the corners of a rotation can miss the source entirely, they still
+        # get a pixel so there's something to crop
+        w, h = size
+        x0 = min(max(math.floor(min(xx)) - margin, 0), w - 1)
+        y0 = min(max(math.floor(min(yy)) - margin, 0), h - 1)
+        return (x0, y0,
+                max(min(math.ceil(max(xx)) + margin, w), x0 + 1),
+                max(min(math.ceil(max(yy)) + margin, h), y0 + 1))
+
+    def window(self, box):
+
+        # The plan for just the part of the output in box
+        x0, y0, x1, y1 = box
+        a, b, c, d, e, f = self.matrix
+        plan = copy.copy(self)
+        plan.matrix = [a, b, a * x0 + b * y0 + c, d, e, d * x0 + e * y0 + f]
+        plan.out_size = (x1 - x0, y1 - y0)
+        return plan
+
+    def band_margin(self):
+
+        # Source pixels around a tile that its resample reaches, Lanczos goes 3 output
+        # pixels out
+        return self.margin + math.ceil(3 * max(self.scale, 1))
+
+    def tile_size(self, budget):
+
+        # The largest tile whose source band, rendered pixels and strip of output fit
+        # in budget bytes. Axis aligned tiles are whole rows, rotated ones read a band
+        # as wide as they are tall so they get narrower too.
+        a, b, c, d, e, f = self.matrix
+        ow, oh = self.out_size
+        pad = 2 * self.band_margin()
+        tw, th = ow, oh
+
+        while True:
+            band = (abs(a) * tw + abs(b) * th + pad) * (abs(d) * tw + abs(e) * th + pad)
+            need = band * 4 * 2 + tw * th * 4 * 3 + ow * th * 4
+            if need <= budget:
+                break
+            if not self.axis_aligned and tw > th and tw > 64:
+                tw = (tw + 1) // 2
+            elif th > 8:
+                th = (th + 1) // 2
+            else:
+                print("Memory limit is too small for this export, going over it")
+                break
+
+        return tw, th
+
+    def export_level(self, pyramid):
+
+        # A reduced level is as good as the source when there's plenty of resolution to
+        # spare, and for a JPEG it means the full image never gets decoded
+        if self.scale < 4:
+            return 0
+        return min(int(math.log2(self.scale / 2)), len(pyramid.levels) - 1)
+
+    def pending_flips(self):
+
+        # Flips left to do after render(transpose=False). Rotated plans flip in the matrix.
+        if self.axis_aligned:
+            return self.flip_hoz, self.flip_vert
+        return False, False
+
+    def preview_level(self, pyramid):
+
+        # The level just larger than the output
+        if self.scale < 2:
+            return 0
+        return min(int(math.log2(self.scale)), len(pyramid.levels) - 1)
+
+    @tracer.timed("render")
+    def render(self, im, job=None, fast=False, transpose=True, origin=None):
+
+        # im is the source or one of its pyramid levels. With origin it's instead the
+        # part of the full size source whose top left corner is there.
+        if origin is None:
+            factor = 2 ** round(math.log2(self.source_size[0] / im.width))
+            m = [v / factor for v in self.matrix]
+            scale = self.scale / factor
+            origin = (0, 0)
+        else:
+            m = list(self.matrix)
+            m[2] -= origin[0]
+            m[5] -= origin[1]
+            scale = self.scale
+
+        if self.axis_aligned:
+
+            # Plain crop and scale. Flips commute with both so they are done last on the small image.
+            ow, oh = self.out_size
+            box = (m[2], m[5], m[0] * ow + m[2], m[4] * oh + m[5])
+            box = (min(box[0], box[2]), min(box[1], box[3]), max(box[0], box[2]), max(box[1], box[3]))
+
+            if all(v == round(v) for v in box) and scale == 1:
+                out = im.crop(tuple(round(v) for v in box))
+                out.load()
+            else:
+                resample = Image.BILINEAR if fast else Image.LANCZOS
+                out = display_mode(im).resize(self.out_size, resample, box=box)
+
+            if job is not None:
+                job.step(0.6)
+
+            # Callers that can flip for free later pass transpose=False, see pending_flips()
+            if transpose and self.flip_hoz:
+                out = out.transpose(method=Image.FLIP_LEFT_RIGHT)
+            if transpose and self.flip_vert:
+                out = out.transpose(method=Image.FLIP_TOP_BOTTOM)
+
+            return out
+
+        # Rotated: read just the region under the output, box filter it down to
+        # within 2x of the output size, then one affine pass does the rest. Bicubic
+        # alone aliases when shrinking, so unless it's fast that pass renders at twice
+        # the output size and is box filtered down too.
+        k = int(scale)
+        x0, y0, x1, y1 = self.get_region(m, im.size)
+
+        # Reduce blocks start on multiples of k in the source, so tiles all agree
+        if k >= 2:
+            x0 = max(x0 - (x0 + origin[0]) % k, 0)
+            y0 = max(y0 - (y0 + origin[1]) % k, 0)
+
+        region = display_mode(im.crop((x0, y0, x1, y1)))
+        m[2] -= x0
+        m[5] -= y0
+
+        if k >= 2:
+            region = region.reduce(k)
+            m = [v / k for v in m]
+
+        if job is not None:
+            job.step(0.5)
+
+        if fast or scale <= max(k, 1):
+            out = region.transform(self.out_size, Image.AFFINE, m,
+                                   resample=Image.BILINEAR if fast else Image.BICUBIC)
+        else:
+            ow, oh = self.out_size
+            m = [m[0] / 2, m[1] / 2, m[2], m[3] / 2, m[4] / 2, m[5]]
+            out = region.transform((ow * 2, oh * 2), Image.AFFINE, m, resample=Image.BICUBIC).reduce(2)
+
+        if job is not None:
+            job.step(0.6)
+
+        return out
+
+
+class PNGStream:
+
+    # Writes a PNG a strip at a time. Rows use the Up filter, which PIL can work out
+    # for a whole strip at once.
+
+    color_types = {"L": 0, "RGB": 2, "RGBA": 6}
+
+    def __init__(self, path, size, mode):
+
+        self.mode = mode if mode in self.color_types else "RGBA"
+        self.above = None
+        self.deflate = zlib.compressobj(6)
+
+        self.file = open(path, "wb")
+        self.file.write(PNGBands.signature)
+        self.chunk(b"IHDR", struct.pack(">IIBBBBB", size[0], size[1], 8, self.color_types[self.mode], 0, 0, 0))
+
+    def chunk(self, kind, data):
+
+        if data or kind != b"IDAT":
+            self.file.write(struct.pack(">I", len(data)) + kind)
+            self.file.write(data)
+            self.file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+    def write(self, strip):
+
+        from PIL import ImageChops
+
+        w, h = strip.size
+
+        # A few rows at a time, filtering makes a handful of copies
+        rows = max((1 << 20) // (w * 4), 1)
+        for y in range(0, h, rows):
+            part = strip.crop((0, y, w, min(y + rows, h)))
+            if part.mode != self.mode:
+                part = part.convert(self.mode)
+
+            above = Image.new(self.mode, part.size)
+            if self.above is not None:
+                above.paste(self.above, (0, 0))
+            above.paste(part.crop((0, 0, w, part.height - 1)), (0, 1))
+            self.above = part.crop((0, part.height - 1, w, part.height))
+
+            data = ImageChops.subtract_modulo(part, above).tobytes()
+            stride = len(data) // part.height
+            self.chunk(b"IDAT", self.deflate.compress(
+                b"".join(b"\2" + data[i:i + stride] for i in range(0, len(data), stride))))
+
+    def close(self):
+
+        self.chunk(b"IDAT", self.deflate.flush())
+        self.chunk(b"IEND", b"")
+        self.file.close()
+
+    def abort(self):
+
+        self.file.close()
+
+
+class JPEGStream:
+
+    # Pipes strips to cjpeg, which encodes them as they come in
+
+    def __init__(self, path, size, exif=None):
+
+        self.path = path
+        self.exif = exif
+        self.process = subprocess.Popen(["cjpeg", "-quality", "95", "-outfile", path],
+                                        stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.process.stdin.write(f"P6\n{size[0]} {size[1]}\n255\n".encode())
+
+    def write(self, strip):
+
+        self.process.stdin.write(strip.convert("RGB").tobytes())
+
+    def close(self):
+
+        self.process.stdin.close()
+        if self.process.wait():
+            raise OSError(f"cjpeg failed: {self.process.stderr.read().decode(errors='replace')}")
+        if self.exif is not None:
+            import piexif
+            piexif.insert(self.exif, self.path)
+
+    def abort(self):
+
+        self.process.kill()
+        self.process.wait()
+
+
+class ImageStream:
+
+    # Without cjpeg the strips are put together in memory and saved as one JPEG
+
+    def __init__(self, path, size, exif=None):
+
+        self.path = path
+        self.exif = exif
+        self.image = Image.new("RGB", size)
+        self.y = 0
+
+    def write(self, strip):
+
+        self.image.paste(strip.convert("RGB"), (0, self.y))
+        self.y += strip.height
+
+    def close(self):
+
+        if self.exif is not None:
+            self.image.save(self.path, "JPEG", quality=95, exif=self.exif)
+        else:
+            self.image.save(self.path, "JPEG", quality=95)
+
+    def abort(self):
+
+        self.image = None
+
+
+def open_stream(path, size, mode, png, exif=None):
+
+    if png:
+        return PNGStream(path, size, mode)
+    if shutil.which("cjpeg"):
+        return JPEGStream(path, size, exif)
+    print("cjpeg not found, the export will be held in memory whole")
+    return ImageStream(path, size, exif)
+
+
+class OutputNamer:
+
+    # Hands out free "name(n).ext" file names. A folder is scanned once and the numbers
+    # in use for each name are kept here, so finding a free one doesn't stat every
+    # candidate. The folder is only scanned again if something else changed it.
+
+    def __init__(self):
+
+        self.folders = {}
+        self.lock = threading.Lock()
+
+    def scan(self, folder):
+
+        index = {}
+        for entry in os.scandir(folder):
+            stem, ext = os.path.splitext(entry.name)
+
+            # Split "name(3)" into "name" and 3, a plain "name" counts as 0
+            n = 0
+            if stem.endswith(")") and "(" in stem:
+                number = stem[stem.rindex("(") + 1:-1]
+                if number.isdigit():
+                    n = int(number)
+                    stem = stem[:stem.rindex("(")]
+
+            index.setdefault((stem, ext), set()).add(n)
+
+        return index
+
+    def reserve(self, path, ext):
+
+        # Creates an empty file at the first free name and returns its path. Creation
+        # fails if the file exists, so exports from other threads or processes can't
+        # get the same name.
+        folder, name = os.path.split(path)
+
+        with self.lock:
+            mtime = os.stat(folder).st_mtime_ns
+            if folder not in self.folders or self.folders[folder][0] != mtime:
+                self.folders[folder] = (mtime, self.scan(folder))
+            used = self.folders[folder][1].setdefault((name, ext), set())
+
+            n = 0
+            while True:
+                while n in used:
+                    n += 1
+                used.add(n)
+
+                extra = f"({str(n)})" if n else ""
+                try:
+                    os.close(os.open(path + extra + ext, os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+                except FileExistsError:
+                    continue
+                break
+
+            self.folders[folder] = (os.stat(folder).st_mtime_ns, self.folders[folder][1])
+
+        return path + extra + ext
+
+
+class Picture:
+    def __init__(self):
+        self.source_image = None
+        self.pyramid = None
+
+        # Bumped for every image set, caches are keyed on it rather than on the image
+        # itself, comparing two PIL images compares all their pixels
+        self.source_id = 0
+        self.surface_pool = SurfacePool()
+        self.surface = None
+        self.surface_key = ()
+        self.base_surface = None
+        self.base_surface_key = ()
+        self.source_w = 0
+        self.source_h = 0
+        self.display_w = 0
+        self.display_h = 0
+        self.display_x = 0
+        self.display_y = 0
+        self.ready = False
+        self.lock_ratio = True
+
+        self.rec_x = 10
+        self.rec_y = 10
+        self.rec_w = 250
+        self.rec_h = 250
+
+        self.drag_start_position = (0, 0)
+
+        self.dragging_center = False
+        self.dragging_tr = False
+        self.dragging_tl = False
+        self.dragging_bl = False
+        self.dragging_br = False
+        self.original_position = (0, 0)
+        self.original_drag_size = (0, 0)
+
+        self.scale_factor = 1
+        self.bounds = (500, 500)
+
+        self.surface184 = None
+
+        self.file_name = ""
+        self.loaded_fullpath = ""
+        self.download_folder = None
+        self.pictures_folder = None
+        self.export_setting = "pictures"
+        self.last_saved_location = ""
+
+        self.sharpen = False
+        self.export_constrain = None
+        self.crop_ratio = (1, 1)
+        self.png = False
+        self.crop = True
+        self.slow_drag = False
+        self.circle = False
+        self.rotation = 0
+        self.flip_hoz = False
+        self.flip_vert = False
+        self.gray = False
+        self.discard_exif = False
+        self.exif = None
+
+        self.corner_hot_area = 60
+        self.all_drag_min = 400
+
+        self.thumbs = [184, 64, 32]
+
+        self.thumb_cache_key = ()
+        self.thumb_cache_img = None
+        self.thumb_cache_flips = (False, False)
+
+        # Previews masked to a circle, redone when thumb_generation changes
+        self.thumb_generation = 0
+        self.circle_surfaces = {}
+
+        self.thumb_surfaces = {}
+
+    def test_br(self, x, y):
+        rx, ry, rw, rh = self.get_display_rect()
+
+        tx = rx + rw
+        ty = ry + rh
+        tw = self.corner_hot_area
+        th = self.corner_hot_area
+
+        tx -= self.corner_hot_area // 2
+        ty -= self.corner_hot_area // 2
+
+        if tx < rx + (rw // 3):
+            tx = rx + (rw // 3)
+
+        if ty < ry + (rh // 3):
+            ty = ry + (rh // 3)
+
+        return point_in_rect(self.display_x + tx, self.display_y + ty, tw, th, x, y)
+
+    def test_tl(self, x, y):
+        rx, ry, rw, rh = self.get_display_rect()
+
+        tx = rx
+        ty = ry
+        tw = self.corner_hot_area
+        th = self.corner_hot_area
+
+        tx -= self.corner_hot_area // 2
+        ty -= self.corner_hot_area // 2
+
+        if ty + th > ry + rh // 3:
+            ty = (ry + rh // 3) - th
+
+        if tx + tw > rx + (rw // 3):
+            tx = (rx + (rw // 3)) - tw
+
+        return point_in_rect(self.display_x + tx, self.display_y + ty, tw, th, x, y)
+
+    def test_bl(self, x, y):
+        rx, ry, rw, rh = self.get_display_rect()
+        tx = rx
+        ty = ry + rh
+        tw = self.corner_hot_area
+        th = self.corner_hot_area
+
+        tx -= self.corner_hot_area // 2
+        ty -= self.corner_hot_area // 2
+
+        if ty < ry + (rh // 3):
+            ty = ry + (rh // 3)
+
+        if tx + tw > rx + (rw // 3):
+            tx = (rx + (rw // 3)) - tw
+
+        return point_in_rect(self.display_x + tx, self.display_y + ty, tw, th, x, y)
+
+    def test_tr(self, x, y):
+        rx, ry, rw, rh = self.get_display_rect()
+        tx = rx + rw
+        ty = ry
+        tw = self.corner_hot_area
+        th = self.corner_hot_area
+
+        tx -= self.corner_hot_area // 2
+        ty -= self.corner_hot_area // 2
+
+        if ty + th > ry + rh // 3:
+            ty = (ry + rh // 3) - th
+
+        if tx < rx + (rw // 3):
+            tx = rx + (rw // 3)
+
+        return point_in_rect(self.display_x + tx, self.display_y + ty, tw, th, x, y)
+
+    def test_center_start_drag(self, x, y):
+
+        rx, ry, rw, rh = self.get_display_rect()
+
+        return point_in_rect(self.display_x + rx, self.display_y + ry, rw, rh, x, y)
+        # border = self.corner_hot_area / 2
+        # if x < self.display_x + rx + border:
+        #     return False
+        # if y < self.display_y + ry + border:
+        #     return False
+        # if x > self.display_x + rx + rw - border:
+        #     return False
+        # if y > self.display_y + ry + rh - border:
+        #     return False
+        # return True
+
+    @tracer.timed("apply_filters")
+    def apply_filters(self, im):
+
+        if self.sharpen:
+            from PIL import ImageFilter
+            im = im.filter(ImageFilter.UnsharpMask(radius=0.35, percent=150, threshold=0))
+
+        return im
+
+    def export_exif(self, size):
+
+        # The source's EXIF for an export of this size, or None to leave it out
+        if self.exif is None or self.discard_exif:
+            return None
+
+        import piexif
+        w, h = size
+        self.exif["0th"][piexif.ImageIFD.XResolution] = (w, 1)
+        self.exif["0th"][piexif.ImageIFD.YResolution] = (h, 1)
+        return piexif.dump(self.exif)
+
+    def export_tiles(self, plan, bands, path, png, job=None):
+
+        # Export without holding the whole source or output in memory. The output is
+        # rendered a tile at a time from just the band of source under it, and written
+        # out a strip of tiles at a time.
+        ow, oh = plan.out_size
+        tw, th = plan.tile_size(ImagePyramid.memory_limit)
+        margin = plan.band_margin()
+        k = 1 if plan.axis_aligned else max(int(plan.scale), 1)
+
+        # Sharpening reads the pixels around each one, so tiles overlap by a little and
+        # are trimmed after filtering
+        overlap = 8 if self.sharpen else 0
+
+        temp = path + ".tmp"
+        stream = None
+        try:
+            for y in range(0, oh, th):
+                strip = None
+                for x in range(0, ow, tw):
+                    box = (max(x - overlap, 0), max(y - overlap, 0),
+                           min(x + tw + overlap, ow), min(y + th + overlap, oh))
+                    tile_plan = plan.window(box)
+
+                    x0, y0, x1, y1 = tile_plan.get_region(tile_plan.matrix, plan.source_size, margin)
+                    x0 -= x0 % k
+                    y0 -= y0 % k
+
+                    tile = display_mode(tile_plan.render(bands.read((x0, y0, x1, y1)), origin=(x0, y0)))
+
+                    if self.gray:
+                        tile = tile.convert("L")
+                        tile = tile.convert("RGB")
+
+                    tile = self.apply_filters(tile)
+                    tile = tile.crop((x - box[0], y - box[1], min(x + tw, ow) - box[0], min(y + th, oh) - box[1]))
+
+                    if strip is None:
+                        strip = Image.new(tile.mode, (ow, tile.height))
+                    strip.paste(tile, (x, 0))
+
+                if stream is None:
+                    stream = open_stream(temp, plan.out_size, strip.mode, png, self.export_exif(plan.out_size))
+                stream.write(strip)
+
+                if job is not None:
+                    job.step(0.3 + 0.6 * min(y + th, oh) / oh)
+
+            stream.close()
+            os.replace(temp, path)
+        except BaseException:
+            if stream is not None:
+                stream.abort()
+            if os.path.isfile(temp):
+                os.remove(temp)
+            raise
+
+    def mcu_size(self, scaled, png):
+
+        # A JPEG that is only being cropped can be cut out of the DCT data directly,
+        # without decoding and re-encoding it, as long as the crop starts on a whole MCU.
+        # Returns the MCU size, or None if the export needs the full pipeline anyway.
+        im = self.source_image
+        if png or scaled or self.rotation or self.flip_hoz or self.flip_vert or self.gray or self.sharpen:
+            return None
+        if im.format != "JPEG" or im.mode not in ("RGB", "L") or not shutil.which("jpegtran"):
+            return None
+
+        # 8 pixels times the largest sampling factor
+        return 8 * max(layer[1] for layer in im.layer), 8 * max(layer[2] for layer in im.layer)
+
+    def lossless_crop_box(self, box, scaled, png):
+
+        # The box if it can be cut losslessly. One that's off the MCU grid is exported
+        # exactly instead, see snap_to_mcu() for lining the selection up.
+        mcu = self.mcu_size(scaled, png)
+        if mcu is None or box[0] % mcu[0] or box[1] % mcu[1]:
+            return None
+        return box
+
+    def snap_to_mcu(self):
+
+        # Move the selection onto the nearest MCU if that makes the export lossless, so
+        # the previews show exactly what will be saved. Returns True if it moved.
+        if not self.source_image or not self.crop:
+            return False
+
+        size = (self.rec_w, self.rec_h)
+        if self.export_constrain:
+            size = fit_size(self.rec_w, self.rec_h, self.export_constrain, self.export_constrain)
+        mcu = self.mcu_size(size != (self.rec_w, self.rec_h), self.png)
+        if mcu is None:
+            return False
+
+        x = round(self.rec_x / mcu[0]) * mcu[0]
+        if x + self.rec_w > self.source_w:
+            x -= mcu[0]
+        y = round(self.rec_y / mcu[1]) * mcu[1]
+        if y + self.rec_h > self.source_h:
+            y -= mcu[1]
+
+        if (x, y) == (self.rec_x, self.rec_y) or x < 0 or y < 0:
+            return False
+        self.rec_x, self.rec_y = x, y
+        return True
+
+    def lossless_crop(self, box, path):
+
+        x, y, r, b = box
+        temp = path + ".tmp"
+        try:
+            subprocess.run(
+                ["jpegtran", "-copy", "none", "-crop", f"{r - x}x{b - y}+{x}+{y}", "-outfile", temp,
+                 self.loaded_fullpath],
+                check=True, stderr=subprocess.PIPE)
+
+            exif_bytes = self.export_exif((r - x, b - y))
+            if exif_bytes is not None:
+                import piexif
+                piexif.insert(exif_bytes, temp)
+
+            os.replace(temp, path)
+        except (OSError, subprocess.CalledProcessError, ValueError) as e:
+            print(f"Lossless crop failed, re-encoding instead: {e}")
+            if os.path.isfile(temp):
+                os.remove(temp)
+            return False
+
+        return True
+
+    def preview_plan(self):
+
+        # The crop box, the size of the largest preview and the plan that renders it
+        if self.crop:
+            box = (self.rec_x, self.rec_y, self.rec_x + self.rec_w, self.rec_y + self.rec_h)
+        else:
+            box = (0, 0, self.source_w, self.source_h)
+
+        biggest = max(self.thumbs)
+        size = fit_size(box[2] - box[0], box[3] - box[1], biggest, biggest)
+        plan = ExportPlan(self.source_image.size, self.rotation, self.flip_hoz, self.flip_vert, box, size)
+        return box, size, plan
+
+    def hq_preview_level(self):
+
+        # The pyramid level HQ previews of the current selection are rendered from
+        if not self.pyramid or not self.thumbs:
+            return None
+        return max(self.preview_plan()[2].export_level(self.pyramid), self.pyramid.hq_level())
+
+    @tracer.timed("gen_thumbnails")
+    def gen_thumbnails(self, hq=False):
+
+        if not self.pyramid or not self.thumbs:
+            return
+
+        box, size, plan = self.preview_plan()
+        biggest = max(self.thumbs)
+
+        # With NumPy the flips and gray are left to the filter pipeline. It doesn't
+        # sharpen, so sharpened previews go through PIL like the export does.
+        filtered = have_numpy() and not self.sharpen
+
+        key = (self.source_id, box, size, self.view_key(), self.gray, hq, filtered)
+        hit = self.thumb_cache_key == key
+        tracer.count("thumb_cache", hit)
+        if hit:
+            cr = self.thumb_cache_img
+        else:
+            # Render the largest preview straight from the source like an export would. Live
+            # previews read from the pyramid level just larger than the preview, so they cost
+            # the same whatever the source size. HQ previews read the level an export would.
+            # Neither reads a level larger than the memory limit allows.
+            if hq:
+                level = plan.export_level(self.pyramid)
+            else:
+                level = plan.preview_level(self.pyramid)
+            im = self.pyramid.get(max(level, self.pyramid.hq_level()))
+            cr = plan.render(im, fast=not hq, transpose=not filtered)
+
+            if self.gray and not filtered:
+                cr = cr.convert("L")
+                cr = cr.convert("RGB")
+
+            self.thumb_cache_key = key
+            self.thumb_cache_img = cr
+            self.thumb_cache_flips = plan.pending_flips()
+
+        # Smaller previews are scaled down from the largest one
+        for size in self.thumbs:
+            im = cr
+            if size != biggest:
+                im = cr.resize(fit_size(cr.width, cr.height, size, size), Image.LANCZOS if hq else Image.BILINEAR)
+
+            old = self.thumb_surfaces.get(size)
+            if filtered:
+                self.thumb_surfaces[size] = self.surface_pool.convert_filtered(
+                    im, old, self.gray, self.thumb_cache_flips)
+            else:
+                im = self.apply_filters(im)
+                self.thumb_surfaces[size] = self.surface_pool.convert(im, old)
+
+        self.thumb_generation += 1
+
+
+    def get_circle_surface(self, size):
+
+        generation, surface = self.circle_surfaces.get(size, (None, None))
+        if generation != self.thumb_generation:
+            self.surface_pool.release(surface)
+            surface = self.surface_pool.acquire(cairo.FORMAT_ARGB32, size, size)
+
+            c = cairo.Context(surface)
+            c.set_operator(cairo.OPERATOR_CLEAR)
+            c.paint()
+            c.set_operator(cairo.OPERATOR_OVER)
+            c.arc(size // 2, size // 2, size // 2, 0, 2 * math.pi)
+            c.clip()
+            c.set_source_surface(self.thumb_surfaces[size], 0, 0)
+            c.paint()
+
+            self.circle_surfaces[size] = (self.thumb_generation, surface)
+
+        return surface
+
+    @tracer.timed("reload")
+    def reload(self, keep_rect=False, quick=False):
+
+        w, h = self.source_image.size
+        self.source_w, self.source_h = rotated_size(w, h, self.rotation)
+        self.display_w, self.display_h = self.source_w, self.source_h
+        self.display_x, self.display_y = 40, 40
+
+        b_w, b_h = self.bounds
+
+        if b_h > 100 and b_w > 100 and b_h - 80 < self.source_h:
+            self.display_w, self.display_h = fit_size(self.source_w, self.source_h, max(b_w - 320, 320), b_h - 80)
+
+        # Work from the smallest pyramid level that is still big enough for the display
+        scale = self.display_h / self.source_h
+        level = self.pyramid.level_for(math.ceil(w * scale), math.ceil(h * scale))
+
+        # A quick reload makes do with whatever has been decoded so far
+        if quick:
+            level = self.pyramid.decoded_level(level)
+
+        im = self.pyramid.get(level)
+
+        if self.flip_hoz:
+            im = im.transpose(method=Image.FLIP_LEFT_RIGHT)
+        if self.flip_vert:
+            im = im.transpose(method=Image.FLIP_TOP_BOTTOM)
+
+        if self.rotation:
+            im = im.rotate(self.rotation, expand=True, resample=Image.BILINEAR)
+
+        if im.size != (self.display_w, self.display_h):
+            im = im.resize((self.display_w, self.display_h), Image.BICUBIC)
+
+        self.scale_factor = self.display_h / self.source_h
+        if not keep_rect:
+            self.rec_w = round(250 / self.scale_factor)
+            self.rec_h = self.rec_w
+
+        self.surface = self.surface_pool.convert(im, self.surface)
+        self.surface_key = self.view_key()
+        self.ready = True
+        self.confine()
+
+    def view_key(self):
+        return self.flip_hoz, self.flip_vert, self.rotation
+
+    def update_view(self):
+
+        # Rotation or flips changed. Rather than re-rasterizing, keep the current display scale
+        # and let the window draw the base surface through a matrix until reload() is called.
+        w, h = self.source_image.size
+        self.source_w, self.source_h = rotated_size(w, h, self.rotation)
+        self.display_w = max(round(self.source_w * self.scale_factor), 1)
+        self.display_h = max(round(self.source_h * self.scale_factor), 1)
+        self.confine()
+
+    @tracer.timed("get_base_surface")
+    def get_base_surface(self):
+
+        # Untransformed source at the current display scale
+        w, h = self.source_image.size
+        size = (max(round(w * self.scale_factor), 1), max(round(h * self.scale_factor), 1))
+
+        key = (self.source_id, size)
+        if self.base_surface is None or self.base_surface_key != key:
+            im = self.pyramid.get(self.pyramid.level_for(*size))
+            if im.size != size:
+                im = im.resize(size, Image.BILINEAR)
+
+            self.base_surface = self.surface_pool.convert(im, self.base_surface)
+            self.base_surface_key = key
+
+        return self.base_surface
+
+    def set_ratio(self):
+
+        if self.crop_ratio and self.crop_ratio != (1, 1):
+
+            if self.crop_ratio == (21, 9) and abs(self.rec_h - 1080) < 50:
+                self.rec_h = 1080
+                self.rec_w = 2560
+
+            elif self.crop_ratio == (16, 9) and abs(self.rec_h - 1080) < 50:
+                self.rec_h = 1080
+                self.rec_w = 1920
+
+            else:
+                a = self.rec_h // self.crop_ratio[1]
+                self.rec_w = a * self.crop_ratio[0]
+                self.rec_h = a * self.crop_ratio[1]
+
+    def confine(self):
+
+        if self.lock_ratio:
+            self.set_ratio()
+
+        # Confine mask rectangle to self
+        if self.rec_x + self.rec_w > self.source_w:
+            self.rec_x = self.source_w - self.rec_w
+        if self.rec_y + self.rec_h > self.source_h:
+            self.rec_y = self.source_h - self.rec_h
+
+        if self.rec_x < 0:
+            self.rec_x = 0
+        if self.rec_y < 0:
+            self.rec_y = 0
+
+        if self.rec_w > self.source_w:
+            self.rec_w = self.source_w
+            if self.lock_ratio:
+                if self.crop_ratio == (1, 1):
+                    self.rec_h = self.rec_w
+
+        if self.rec_h > self.source_h:
+            self.rec_h = self.source_h
+            if self.lock_ratio:
+                self.rec_w = self.rec_h
+
+    def set_source(self, path, image, exif, pyramid=None):
+
+        self.loaded_fullpath = path
+        self.file_name = os.path.splitext(os.path.basename(path))[0]
+        self.source_image = image
+        self.source_id += 1
+        self.exif = exif
+        self.pyramid = pyramid
+
+        w, h = image.size
+        self.source_w, self.source_h = rotated_size(w, h, self.rotation)
+
+    def open(self, path):
+
+        self.set_source(path, *open_image(path))
+
+    def load(self, path, bounds):
+
+        self.bounds = bounds
+        self.open(path)
+        self.reload()
+        self.gen_thumbnails(hq=True)
+
+    def get_display_rect_hw(self):
+        return round(self.rec_h + self.rec_w)
+
+    def get_display_rect(self):
+
+        return (round(self.rec_x * self.scale_factor),
+                round(self.rec_y * self.scale_factor),
+                round(self.rec_w * self.scale_factor),
+                round(self.rec_h * self.scale_factor))
+
+    def save_display_rect(self, x, y, w, h):
+
+        self.rec_x = round(x / self.scale_factor)
+        self.rec_y = round(y / self.scale_factor)
+        self.rec_w = round(w / self.scale_factor)
+        self.rec_h = round(h / self.scale_factor)
+
+    def snapshot(self):
+
+        # Copy of the current settings for an export job, so editing can carry on meanwhile
+        snap = copy.copy(self)
+        snap.exif = copy.deepcopy(self.exif)
+        snap.thumbs = list(self.thumbs)
+        snap.thumb_surfaces = {}
+        snap.thumb_cache_img = None
+        return snap
+
+    @tracer.timed("export")
+    def export(self, path=None, folder=None, job=None):
+
+        show_notice = True
+        if path is not None:
+            show_notice = False
+            base_folder = os.path.dirname(path)
+        elif folder is not None:
+            show_notice = False
+            base_folder = folder
+        else:
+            if self.export_setting == "pictures":
+                base_folder = self.pictures_folder
+            elif self.export_setting == "download":
+                base_folder = self.download_folder
+            elif self.export_setting == "overwrite":
+                base_folder = os.path.dirname(self.loaded_fullpath)
+                path = self.loaded_fullpath
+            else:
+                print("Export setting error")
+                return
+
+        print(f"Target folder is: {base_folder}")
+
+        if not os.path.isdir(base_folder):
+            if job is not None:
+                job.output_missing = True
+            else:
+                print("Could not locate output folder!")
+            return
+
+        if not self.source_image:
+            return
+
+        if job is not None:
+            job.step(0.05)
+
+        if self.crop:
+            box = (self.rec_x, self.rec_y, self.rec_x + self.rec_w, self.rec_y + self.rec_h)
+            cropped = True
+        else:
+            box = (0, 0, self.source_w, self.source_h)
+            cropped = False
+
+        size = (box[2] - box[0], box[3] - box[1])
+        if self.export_constrain:
+            size = fit_size(size[0], size[1], self.export_constrain, self.export_constrain)
+        scaled = size != (box[2] - box[0], box[3] - box[1])
+
+        png = self.png
+
+        overwrite = False
+
+        if path is None:
+
+            path = os.path.join(base_folder, self.file_name)
+
+            if cropped:
+                path += "-cropped"
+
+            if scaled:
+                path += "-scaled"
+
+            ext = '.jpg'
+            if png:
+                ext = '.png'
+
+        else:
+            if path.lower().endswith(".png"):
+                png = True
+            else:
+                png = False
+            overwrite = True
+
+        # About to overwrite the source, so make sure nothing will need to read it again
+        if path == self.loaded_fullpath and self.pyramid.fits(0):
+            self.pyramid.get(0)
+
+        if not overwrite:
+            path = output_namer.reserve(path, ext)
+
+        try:
+            lossless_box = self.lossless_crop_box(box, scaled, png)
+            if lossless_box is None or not self.lossless_crop(lossless_box, path):
+
+                # Rotation, crop and scale are done as a single resample from the source
+                plan = ExportPlan(self.source_image.size, self.rotation, self.flip_hoz, self.flip_vert, box, size)
+                level = plan.export_level(self.pyramid)
+
+                bands = None
+                if not self.pyramid.fits(level):
+                    bands = open_bands(self.source_image, self.loaded_fullpath)
+                    if bands is None:
+                        print(f"Can't export {self.source_image.format} in tiles, decoding it whole")
+
+                if bands is not None:
+                    self.export_tiles(plan, bands, path, png, job)
+                else:
+                    if level:
+                        im = self.pyramid.get(level)
+                    else:
+                        im = self.pyramid.source()
+
+                    if job is not None:
+                        job.step(0.3)
+
+                    cr = plan.render(im, job)
+
+                    # Filters only need to touch the final pixels
+                    if self.gray:
+                        cr = cr.convert("L")
+                        cr = cr.convert("RGB")
+
+                    cr = self.apply_filters(cr)
+
+                    if job is not None:
+                        job.step(0.7)
+
+                    if png:
+                        cr.save(path, "PNG")
+                    else:
+
+                        cr = cr.convert("RGB")
+
+                        exif_bytes = self.export_exif(cr.size)
+                        if exif_bytes is not None:
+                            cr.save(path, "JPEG", quality=95, exif=exif_bytes)
+                        else:
+
+                            cr.save(path, "JPEG", quality=95)
+        except Exception:
+            # Don't leave the reserved name behind as an empty file
+            if not overwrite and os.path.isfile(path):
+                os.remove(path)
+            raise
+
+        self.last_saved_location = os.path.dirname(path)
+
+        if job is not None:
+            job.progress = 1
+            job.show_notice = show_notice
+
+        return path
+
+
+output_namer = OutputNamer()
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+class ExportJob:
+
+    def __init__(self, snapshot, path=None):
+
+        self.picture = snapshot
+        self.path = path
+
+        self.progress = 0
+        self.cancelled = False
+        self.show_notice = False
+        self.output_missing = False
+        self.saved_path = None
+        self.error = None
+
+    def step(self, progress):
+
+        # Called between export stages, which is where a cancelled job stops
+        if self.cancelled:
+            raise ExportCancelled()
+        self.progress = progress
+
+
+# Folder navigation ----------------------------------------------------------
+
+image_extensions = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff", ".jp2")
+
+
+def list_folder(path):
+
+    folder = os.path.dirname(os.path.abspath(path))
+    try:
+        names = sorted(os.listdir(folder), key=str.lower)
+    except OSError:
+        return [path]
+    return [os.path.join(folder, name) for name in names if name.lower().endswith(image_extensions)]
+
+
+def open_image(path, cache=None):
+
+    image = Image.open(path)
+
+    exif = None
+    if "exif" in image.info:
+        import piexif
+        exif = piexif.load(image.info["exif"])
+
+    return image, exif, ImagePyramid(image, path, cache)
+
+
+def display_level(pyramid, bounds):
+
+    # The pyramid level the window will draw the image from, see Picture.reload
+    w, h = pyramid.sizes[0]
+    b_w, b_h = bounds
+    d_w, d_h = fit_size(w, h, max(b_w - 320, 320), max(b_h - 80, 80))
+    return pyramid.level_for(d_w, d_h)
+
+
+class Prefetcher:
+
+    # Opens the images either side of the current one in the background so that
+    # stepping through a folder doesn't have to wait for them to decode
+
+    ahead = 3
+    behind = 1
+
+    def __init__(self, cache=None):
+
+        self.cache = cache
+        self.entries = {}
+        self.wanted = []
+        self.bounds = (0, 0)
+        self.busy = None
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def update(self, paths, index, bounds):
+
+        wanted = paths[index + 1:index + 1 + self.ahead] + paths[max(index - self.behind, 0):index]
+
+        # The image being opened isn't prefetched, but one that already is stays until
+        # the loader takes it
+        keep = wanted + paths[index:index + 1]
+
+        with self.condition:
+            self.wanted = wanted
+            self.bounds = bounds
+            for path in list(self.entries):
+                if path not in keep:
+                    del self.entries[path]
+            self.condition.notify_all()
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.worker)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def take(self, path):
+
+        # Returns (image, exif, pyramid) if the image is prefetched, otherwise None
+        with self.condition:
+            while self.busy == path:
+                self.condition.wait()
+            return self.entries.pop(path, None)
+
+    def worker(self):
+
+        while True:
+            with self.condition:
+                todo = [path for path in self.wanted if path not in self.entries]
+                while not todo:
+                    self.condition.wait()
+                    todo = [path for path in self.wanted if path not in self.entries]
+                path = todo[0]
+                bounds = self.bounds
+                self.busy = path
+
+            entry = None
+            try:
+                entry = open_image(path, self.cache)
+                entry[2].get(display_level(entry[2], bounds))
+            except Exception as e:
+                print(f"Failed to prefetch {path}: {e}")
+
+            # Kept even if no longer wanted, it may be the image that's being opened now
+            with self.condition:
+                self.entries[path] = entry
+                self.busy = None
+                self.condition.notify_all()
+
+
+# Batch export ---------------------------------------------------------------
+
+def pictures_folder():
+
+    # The lookup GLib.get_user_special_dir does, so batch mode doesn't need GLib
+    config_home = os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser("~/.config")
+    try:
+        with open(os.path.join(config_home, "user-dirs.dirs")) as f:
+            for line in f:
+                if line.startswith("XDG_PICTURES_DIR="):
+                    return os.path.expandvars(line.split("=", 1)[1].strip().strip('"'))
+    except OSError:
+        pass
+    return None
+
+
+def parse_rect(text):
+    try:
+        rect = tuple(int(v) for v in text.split(","))
+    except ValueError:
+        rect = ()
+    if len(rect) != 4:
+        raise argparse.ArgumentTypeError("expected X,Y,W,H")
+    return rect
+
+
+# Runs in a worker process, so it uses its own Picture
+def batch_export(job):
+
+    path, options = job
+
+    if options.memory_limit:
+        ImagePyramid.memory_limit = options.memory_limit * 1024 * 1024
+
+    p = Picture()
+    p.gray = options.gray
+    p.sharpen = options.sharpen
+    p.flip_hoz = options.flip_h
+    p.flip_vert = options.flip_v
+    p.rotation = options.rotate
+    p.export_constrain = options.size
+    p.png = options.png
+    p.discard_exif = options.discard_exif
+    p.lock_ratio = False
+    p.crop = False
+
+    try:
+        p.open(path)
+
+        if options.crop:
+            p.crop = True
+            p.rec_x, p.rec_y, p.rec_w, p.rec_h = options.crop
+        elif options.square:
+            p.crop = True
+            p.rec_w = p.rec_h = min(p.source_w, p.source_h)
+            p.rec_x = (p.source_w - p.rec_w) // 2
+            p.rec_y = (p.source_h - p.rec_h) // 2
+
+        p.confine()
+        return path, p.export(folder=options.output), None
+
+    except Exception as e:
+        return path, None, str(e)
+
+
+def batch_main(argv):
+
+    parser = argparse.ArgumentParser(
+        prog="avvie --batch",
+        description="Crop and export images without opening a window."
+    )
+    parser.add_argument("--batch", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("files", nargs="+", help="image files or glob patterns")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="number of worker processes (default: number of cores)")
+    parser.add_argument("-o", "--output", default=pictures_folder() or os.getcwd(),
+                        help="output folder (default: Pictures)")
+    parser.add_argument("--crop", type=parse_rect, metavar="X,Y,W,H",
+                        help="crop rectangle, after rotation and flips")
+    parser.add_argument("--square", action="store_true", help="crop the largest centered square")
+    parser.add_argument("--size", type=int, metavar="N", help="downscale to fit within NxN")
+    parser.add_argument("--rotate", type=float, default=0, metavar="DEG",
+                        help="rotate counter-clockwise by DEG degrees")
+    parser.add_argument("--flip-h", action="store_true", help="flip horizontally")
+    parser.add_argument("--flip-v", action="store_true", help="flip vertically")
+    parser.add_argument("--gray", action="store_true", help="convert to grayscale")
+    parser.add_argument("--sharpen", action="store_true", help="apply sharpen filter")
+    parser.add_argument("--png", action="store_true", help="export as PNG instead of JPEG")
+    parser.add_argument("--discard-exif", action="store_true", help="don't copy EXIF data")
+    parser.add_argument("--memory-limit", type=int, metavar="MB",
+                        help="process larger images in tiles to stay within MB per worker")
+    options = parser.parse_args(argv)
+
+    files = []
+    for pattern in options.files:
+        if os.path.isfile(pattern):
+            files.append(pattern)
+        else:
+            files.extend(f for f in sorted(glob.glob(os.path.expanduser(pattern))) if os.path.isfile(f))
+
+    if not files:
+        print("No input files found")
+        return 1
+
+    if not os.path.isdir(options.output):
+        os.makedirs(options.output)
+
+    jobs = [(path, options) for path in files]
+    failed = 0
+
+    # Fork the workers where possible. Started any other way they import main.py again,
+    # which sets up GTK in every one of them.
+    start = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+    context = multiprocessing.get_context(start)
+
+    with context.Pool(max(1, min(options.jobs, len(files)))) as pool:
+        for i, (path, out, error) in enumerate(pool.imap_unordered(batch_export, jobs), 1):
+            if error is not None:
+                failed += 1
+                print(f"[{i}/{len(files)}] Failed {path}: {error}")
+            else:
+                print(f"[{i}/{len(files)}] {path} -> {out}")
+
+    print(f"Exported {len(files) - failed} of {len(files)} images")
+    return 1 if failed else 0
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+
+# Times Picture.load, reload, gen_thumbnails and export over generated images of several
+# sizes and modes and every combination of rotation, flips and output filters. Needs no
+# display. Results are written as JSON so two runs can be compared.
+#
+# --verify checks the export pixels instead of timing anything. Each export is compared
+# with the same export done in tiles under a small memory limit, and with the original
+# gray, flip, rotate, crop, thumbnail pipeline it replaced.
+#
+#   python3 benchmarks/suite.py [-o results.json] [--repeat N] [--quick] [--only TEXT]
+#   python3 benchmarks/suite.py --compare old.json new.json
+#   python3 benchmarks/suite.py --verify [--quick] [--only TEXT]
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import itertools
+import statistics
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import PIL
+from PIL import Image, ImageChops, ImageStat
+import avvie_core
+from avvie_core import Picture, ImagePyramid
+
+# (mode, width, height, format), the large ones only run without --quick
+IMAGES = [
+    ("RGB", 640, 480, "JPEG"),
+    ("RGB", 3000, 2000, "JPEG"),
+    ("RGB", 3000, 2000, "PNG"),
+    ("RGBA", 3000, 2000, "PNG"),
+    ("L", 3000, 2000, "JPEG"),
+    ("L", 3000, 2000, "PNG"),
+    ("RGB", 6000, 4000, "JPEG"),
+    ("RGB", 6000, 4000, "PNG"),
+]
+QUICK_MAX_PIXELS = 3000 * 2000
+
+ROTATIONS = [0, 12.5]
+FLIPS = [(False, False), (True, False), (False, True), (True, True)]
+OUTPUTS = ["plain", "gray", "sharpen", "scale"]
+
+BOUNDS = (1200, 760)
+
+# Memory limit for the tiled exports in --verify, small enough that every image is tiled
+VERIFY_LIMIT = 4 * 1024 * 1024
+
+# Largest difference allowed between tiled and whole exports (a tile's resample offsets
+# are worked out differently, so the odd pixel rounds the other way), and mean difference
+# allowed from the old pipeline. That one resampled twice when rotating and always scaled
+# with Lanczos, where rotated exports now box filter, which shows most on the noise.
+TILED_MAX = 2
+REFERENCE_MEAN = 3.0
+
+
+def make_image(mode, w, h):
+
+    # Mandelbrot detail plus noise, so JPEG and PNG have something realistic to compress
+    small = (max(w // 4, 1), max(h // 4, 1))
+    detail = Image.effect_mandelbrot(small, (-2.2, -1.2, 1, 1.2), 64).resize((w, h), Image.BICUBIC)
+    noise = Image.effect_noise((w, h), 24)
+    gradient = Image.linear_gradient("L").resize((w, h))
+
+    if mode == "L":
+        return Image.blend(detail, noise, 0.2)
+
+    im = Image.merge("RGB", (detail, Image.blend(gradient, noise, 0.3), noise))
+    if mode == "RGBA":
+        im.putalpha(gradient.rotate(90).resize((w, h)))
+    return im
+
+
+def transform_name(rotation, flips, output):
+
+    parts = []
+    if rotation:
+        parts.append(f"rotate{rotation}")
+    if flips[0]:
+        parts.append("flip-h")
+    if flips[1]:
+        parts.append("flip-v")
+    if output != "plain":
+        parts.append(output)
+    return "+".join(parts) or "identity"
+
+
+def set_transform(p, rotation, flips, output):
+
+    p.rotation = rotation
+    p.flip_hoz, p.flip_vert = flips
+    p.gray = output == "gray"
+    p.sharpen = output == "sharpen"
+    p.export_constrain = 512 if output == "scale" else None
+
+
+def measure(function, repeat):
+
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def run(options):
+
+    folder = tempfile.mkdtemp(prefix="avvie-bench-")
+    output_folder = os.path.join(folder, "out")
+    os.mkdir(output_folder)
+
+    results = []
+
+    def record(benchmark, image, transform, times):
+        results.append({
+            "benchmark": benchmark,
+            "image": image,
+            "transform": transform,
+            "times": times,
+            "min": min(times),
+            "median": statistics.median(times),
+        })
+        print(f"{benchmark:16}{image:24}{transform:32}{min(times) * 1000:10.2f} ms")
+
+    def export(p):
+        os.remove(p.export(folder=output_folder))
+
+    try:
+        for mode, w, h, format in IMAGES:
+            if options.quick and w * h > QUICK_MAX_PIXELS:
+                continue
+
+            name = f"{mode.lower()}-{w}x{h}.{'jpg' if format == 'JPEG' else 'png'}"
+            path = os.path.join(folder, name)
+            make_image(mode, w, h).save(path, format)
+
+            p = Picture()
+            record("load", name, "identity", measure(lambda: p.load(path, BOUNDS), options.repeat))
+
+            for rotation, flips, output in itertools.product(ROTATIONS, FLIPS, OUTPUTS):
+                transform = transform_name(rotation, flips, output)
+                if options.only and options.only not in f"{name} {transform}":
+                    continue
+
+                set_transform(p, rotation, flips, output)
+                p.reload()
+                p.rec_x = (p.source_w - p.rec_w) // 2
+                p.rec_y = (p.source_h - p.rec_h) // 2
+
+                record("reload", name, transform, measure(lambda: p.reload(keep_rect=True), options.repeat))
+
+                for hq in (False, True):
+                    def previews():
+                        p.thumb_cache_key = ()
+                        p.gen_thumbnails(hq=hq)
+                    record("previews-hq" if hq else "previews", name, transform, measure(previews, options.repeat))
+
+                record("export", name, transform, measure(lambda: export(p), options.repeat))
+
+    finally:
+        shutil.rmtree(folder)
+
+    return {
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "numpy": avvie_core.have_numpy(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "repeat": options.repeat,
+        "results": results,
+    }
+
+
+def reference_export(p):
+
+    # Export the way Picture.export did before the single resample ExportPlan
+    im = p.source_image
+
+    if p.gray:
+        im = im.convert("L")
+        im = im.convert("RGB")
+
+    if p.flip_hoz:
+        im = im.transpose(method=Image.FLIP_LEFT_RIGHT)
+    if p.flip_vert:
+        im = im.transpose(method=Image.FLIP_TOP_BOTTOM)
+
+    if p.rotation:
+        im = im.rotate(p.rotation, expand=True, resample=Image.BICUBIC)
+
+    cr = im.crop((p.rec_x, p.rec_y, p.rec_x + p.rec_w, p.rec_y + p.rec_h))
+    if p.export_constrain:
+        cr.thumbnail((p.export_constrain, p.export_constrain), Image.LANCZOS)
+
+    return p.apply_filters(cr)
+
+
+def difference(a, b):
+
+    # Largest and mean channel difference. Images with alpha are compared as they look
+    # over black plus their alpha, the colour of transparent pixels doesn't matter.
+    if a.size != b.size:
+        return None
+
+    def flatten(im):
+        if "A" not in im.getbands():
+            return im.convert("RGB")
+        im = im.convert("RGBA")
+        rgb = Image.alpha_composite(Image.new("RGBA", im.size, (0, 0, 0, 255)), im).convert("RGB")
+        return Image.merge("RGBA", rgb.split() + (im.getchannel("A"),))
+
+    diff = ImageChops.difference(flatten(a), flatten(b))
+    return max(hi for lo, hi in diff.getextrema()), max(ImageStat.Stat(diff).mean)
+
+
+def verify(options):
+
+    folder = tempfile.mkdtemp(prefix="avvie-verify-")
+    failed = 0
+    checked = 0
+
+    def export(p, limit):
+        ImagePyramid.memory_limit = limit
+        try:
+            path = p.export(folder=folder)
+        finally:
+            ImagePyramid.memory_limit = None
+        im = Image.open(path)
+        im.load()
+        os.remove(path)
+        return im
+
+    try:
+        for mode, w, h, format in IMAGES:
+            if options.quick and w * h > QUICK_MAX_PIXELS:
+                continue
+
+            name = f"{mode.lower()}-{w}x{h}.{'jpg' if format == 'JPEG' else 'png'}"
+            path = os.path.join(folder, name)
+            make_image(mode, w, h).save(path, format)
+
+            p = Picture()
+            p.load(path, BOUNDS)
+            p.png = True
+            tiled = avvie_core.open_bands(p.source_image, path) is not None
+            checked_before = checked
+
+            for rotation, flips, output in itertools.product(ROTATIONS, FLIPS, OUTPUTS):
+                transform = transform_name(rotation, flips, output)
+                if options.only and options.only not in f"{name} {transform}":
+                    continue
+
+                set_transform(p, rotation, flips, output)
+                p.reload()
+                p.crop = True
+                p.rec_w = p.rec_h = min(p.source_w, p.source_h) * 2 // 3
+                p.rec_x = (p.source_w - p.rec_w) // 2
+                p.rec_y = (p.source_h - p.rec_h) // 2
+
+                whole = export(p, None)
+                problems = []
+
+                if tiled:
+                    result = difference(whole, export(p, VERIFY_LIMIT))
+                    if result is None or result[0] > TILED_MAX:
+                        problems.append(f"tiled {result or 'size differs'}")
+
+                result = difference(whole, reference_export(p))
+                if result is None or result[1] > REFERENCE_MEAN:
+                    problems.append(f"reference {result or 'size differs'}")
+
+                checked += 1
+                if problems:
+                    failed += 1
+                print(f"{name:24}{transform:34}{'FAIL ' + ', '.join(problems) if problems else 'ok'}")
+
+            if not tiled and checked > checked_before:
+                print(f"{name:24}no band reader, tiled export not checked")
+
+    finally:
+        shutil.rmtree(folder)
+
+    print(f"{checked - failed} of {checked} exports match")
+    return 1 if failed else 0
+
+
+def compare(old_file, new_file):
+
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+
+    def key(result):
+        return result["benchmark"], result["image"], result["transform"]
+
+    before = {key(result): result["min"] for result in old["results"]}
+
+    print(f"{'':16}{'':24}{'':32}{'old ms':>10}{'new ms':>10}{'ratio':>8}")
+    for result in new["results"]:
+        if key(result) not in before:
+            continue
+        a = before[key(result)]
+        b = result["min"]
+        print(f"{result['benchmark']:16}{result['image']:24}{result['transform']:32}"
+              f"{a * 1000:10.2f}{b * 1000:10.2f}{b / a if a else 0:8.2f}")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark loading, previews and export")
+    parser.add_argument("-o", "--output", default="bench-results.json", help="JSON file to write results to")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each benchmark, the fastest counts")
+    parser.add_argument("--quick", action="store_true", help="skip the largest images")
+    parser.add_argument("--only", help="only run image/transform combinations containing this text")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files")
+    parser.add_argument("--verify", action="store_true",
+                        help="check exports against tiled exports and the old pipeline instead of timing")
+    options = parser.parse_args()
+
+    if options.compare:
+        compare(*options.compare)
+        return
+
+    if options.verify:
+        sys.exit(verify(options))
+
+    report = run(options)
+    with open(options.output, "w") as f:
+        json.dump(report, f, indent=1)
+    print(f"Results written to {options.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+# Compares the old PIL to cairo conversion with SurfacePool.convert over a run of
+# simulated drag events, reporting surfaces created and Python memory allocated per event.
+#
+#   python3 benchmarks/surface_pool.py [events]
+
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cairo
+from PIL import Image
+import avvie_core
+from avvie_core import Picture, ImagePyramid
+
+
+class LegacyConverter:
+
+    # What Picture did before SurfacePool: putalpha, tobytes, bytearray, new surface every time
+
+    def __init__(self):
+        self.allocations = 0
+
+    def convert(self, im, old=None):
+
+        if "A" not in im.getbands():
+            im.putalpha(int(1 * 256.0))
+
+        by = im.tobytes("raw", "BGRa")
+        arr = bytearray(by)
+
+        self.allocations += 1
+        return cairo.ImageSurface.create_for_data(
+            arr, cairo.FORMAT_ARGB32, im.width, im.height
+        )
+
+
+def make_picture():
+
+    im = Image.effect_mandelbrot((4000, 3000), (-2.2, -1.2, 1, 1.2), 64).convert("RGB")
+
+    p = Picture()
+    p.thumbs = [184, 64, 32]
+    p.set_source("benchmark.png", im, None, ImagePyramid(im))
+    p.rec_x, p.rec_y, p.rec_w, p.rec_h = 500, 500, 1500, 1500
+    return p
+
+
+def run(p, converter, events):
+
+    p.surface_pool = converter
+    p.thumb_surfaces.clear()
+    p.gen_thumbnails()
+
+    start_allocations = converter.allocations
+    peak = 0
+
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    for i in range(events):
+        # Each event moves the selection like a drag would
+        p.rec_x = 500 + i % 200
+        p.rec_y = 500 + i % 150
+
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        p.gen_thumbnails()
+        peak += tracemalloc.get_traced_memory()[1] - base
+
+    elapsed = time.perf_counter() - start
+    tracemalloc.stop()
+
+    return (converter.allocations - start_allocations) / events, peak / events, elapsed / events
+
+
+def main():
+
+    events = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    # Both runs go through the PIL filters and convert(), convert_filtered() is NumPy's
+    # own path and LegacyConverter has nothing to compare it with
+    avvie_core.numpy = None
+    avvie_core.numpy_checked = True
+    p = make_picture()
+
+    print(f"{events} drag events, previews {p.thumbs}")
+    print(f"{'':10}{'surfaces/event':>16}{'KiB/event':>12}{'ms/event':>10}")
+
+    for name, converter in (("before", LegacyConverter()), ("after", p.surface_pool)):
+        surfaces, peak, elapsed = run(p, converter, events)
+        print(f"{name:10}{surfaces:16.2f}{peak / 1024:12.1f}{elapsed * 1000:10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -20,18 +20,38 @@
 import os
 import sys
 import math
-import gi
-import cairo
 import urllib.parse
 import subprocess
-import piexif
 import json
-from PIL import Image, ImageFilter
+import threading
+import queue
+import hashlib
+import collections
+import time
+
+# Run with --startup-time to print how long it takes to get the window up
+startup_start = time.perf_counter()
+startup_timing = "--startup-time" in sys.argv
+
+
+def startup_mark(name):
+    if startup_timing:
+        print(f"Startup: {name} after {(time.perf_counter() - startup_start) * 1000:.1f} ms")
+
+from avvie_core import Picture, ImagePyramid, ProxyCache, ExportCancelled, ExportJob, Prefetcher, \
+    list_folder, open_image, display_level, tracer, batch_main
+
+# Batch export doesn't need GTK at all, so skip loading it
+if __name__ == "__main__" and "--batch" in sys.argv:
+    sys.exit(batch_main(sys.argv[1:]))
+
+import gi
+import cairo
 
 gi.require_version("Gtk", "3.0")
 gi.require_foreign("cairo")
 gi.require_version('Notify', '0.7')
-from gi.repository import Gtk, Gdk, Gio, GLib, Notify, GdkPixbuf
+from gi.repository import Gtk, Gdk, Gio, GLib, GdkPixbuf
 
 app_title = "Avvie"
 app_id = "com.github.taiko2k.avvie"
@@ -60,10 +80,7 @@ if os.path.isfile(config_file):
         config = json.load(f)
         print(f"Loaded config {config_file}")
 
-# Add
-Notify.init(app_title)
-notify = Notify.Notification.new(app_title, "Image file exported to Downloads.")
-notify_invalid_output = Notify.Notification.new(app_title, "Could not locate output folder!")
+startup_mark("imports and config")
 
 # Is this defined somewhere in Gtk?
 TARGET_TYPE_URI_LIST = 80
@@ -74,514 +91,252 @@ def open_encode_out(notification, action, data):
     subprocess.call(["xdg-open", picture.last_saved_location])
 
 
-notify.add_action(
-    "action_click",
-    "Open output folder",
-    open_encode_out,
-    None
-)
-
-def point_in_rect(rx, ry, rw, rh, px, py):
-    return ry < py < ry + rh and rx < px < rx + rw
+class Notices:
 
-# Get distance between two points (pythagoras)
-def point_prox(x1, y1, x2, y2):
-    return math.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
+    # Notify.init is a blocking D-Bus call, so the notifications are only set up
+    # when the first one is shown rather than at startup
 
-class FileChooserWithImagePreview(Gtk.FileChooserNative):
-    resize_to = (256, 256)
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-    
-        self.preview_widget = Gtk.Image()
-        self.set_preview_widget(self.preview_widget)
-        self.connect(
-            "update-preview",
-            self.update_preview,
-            self.preview_widget
-        )
-    
-    def update_preview(self, dialog, preview_widget):
-        filename = self.get_preview_filename()
-        try:
-            pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(filename, *self.resize_to)
-            preview_widget.set_from_pixbuf(pixbuf)
-            have_preview = True
-        except:
-            have_preview = False
-
-        self.set_preview_widget_active(have_preview)
-
-class Picture:
     def __init__(self):
-        self.source_image = None
-        self.surface = None
-        self.source_w = 0
-        self.source_h = 0
-        self.display_w = 0
-        self.display_h = 0
-        self.display_x = 0
-        self.display_y = 0
-        self.ready = False
-        self.lock_ratio = True
-
-        self.rec_x = 10
-        self.rec_y = 10
-        self.rec_w = 250
-        self.rec_h = 250
-
-        self.drag_start_position = (0, 0)
-
-        self.dragging_center = False
-        self.dragging_tr = False
-        self.dragging_tl = False
-        self.dragging_bl = False
-        self.dragging_br = False
-        self.original_position = (0, 0)
-        self.original_drag_size = (0, 0)
-
-        self.scale_factor = 1
-        self.bounds = (500, 500)
-
-        self.surface184 = None
-
-        self.file_name = ""
-        self.loaded_fullpath = ""
-        self.download_folder = GLib.get_user_special_dir(GLib.UserDirectory.DIRECTORY_DOWNLOAD)
-        self.pictures_folder = GLib.get_user_special_dir(GLib.UserDirectory.DIRECTORY_PICTURES)
-        self.export_setting = "pictures"
-        if "output-mode" in config:
-            self.export_setting = config["output-mode"]
-        self.last_saved_location = ""
-
-        self.sharpen = False
-        self.export_constrain = None
-        self.crop_ratio = (1, 1)
-        self.png = False
-        self.crop = True
-        self.slow_drag = False
-        self.circle = False
-        self.rotation = 0
-        self.flip_hoz = False
-        self.flip_vert = False
-        self.gray = False
-        self.discard_exif = False
-        self.exif = None
-
-        self.corner_hot_area = 60
-        self.all_drag_min = 400
-
-        self.thumbs = [184, 64, 32]
-
-        self.thumb_cache_key = ()
-        self.thumb_cache_img = None
-
-
-        # Load thumbnail sizes from saved config
-        if "thumbs" in config:
-            try:
-                thumbs = config["thumbs"]
-                for size in thumbs:
-                    assert type(size) is int
-                self.thumbs = thumbs
-            except:
-                print("Error reading config")
-                raise
-
-        self.thumb_surfaces = {}
-
-    def test_br(self, x, y):
-        rx, ry, rw, rh = self.get_display_rect()
-
-        tx = rx + rw
-        ty = ry + rh
-        tw = self.corner_hot_area
-        th = self.corner_hot_area
-
-        tx -= self.corner_hot_area // 2
-        ty -= self.corner_hot_area // 2
-
-        if tx < rx + (rw // 3):
-            tx = rx + (rw // 3)
-
-        if ty < ry + (rh // 3):
-            ty = ry + (rh // 3)
-
-        return point_in_rect(picture.display_x + tx, picture.display_y + ty, tw, th, x, y)
-
-    def test_tl(self, x, y):
-        rx, ry, rw, rh = self.get_display_rect()
-
-        tx = rx
-        ty = ry
-        tw = self.corner_hot_area
-        th = self.corner_hot_area
 
-        tx -= self.corner_hot_area // 2
-        ty -= self.corner_hot_area // 2
+        self.exported = None
+        self.invalid_output = None
+        self.exported_text = "Image file exported to Downloads."
 
-        if ty + th > ry + rh // 3:
-            ty = (ry + rh // 3) - th
+    def setup(self):
 
-        if tx + tw > rx + (rw // 3):
-            tx = (rx + (rw // 3)) - tw
-
-        return point_in_rect(picture.display_x + tx, picture.display_y + ty, tw, th, x, y)
-
-    def test_bl(self, x, y):
-        rx, ry, rw, rh = self.get_display_rect()
-        tx = rx
-        ty = ry + rh
-        tw = self.corner_hot_area
-        th = self.corner_hot_area
-
-        tx -= self.corner_hot_area // 2
-        ty -= self.corner_hot_area // 2
-
-        if ty < ry + (rh // 3):
-            ty = ry + (rh // 3)
-
-        if tx + tw > rx + (rw // 3):
-            tx = (rx + (rw // 3)) - tw
-
-        return point_in_rect(picture.display_x + tx, picture.display_y + ty, tw, th, x, y)
-
-    def test_tr(self, x, y):
-        rx, ry, rw, rh = self.get_display_rect()
-        tx = rx + rw
-        ty = ry
-        tw = self.corner_hot_area
-        th = self.corner_hot_area
-
-        tx -= self.corner_hot_area // 2
-        ty -= self.corner_hot_area // 2
-
-        if ty + th > ry + rh // 3:
-            ty = (ry + rh // 3) - th
-
-        if tx < rx + (rw // 3):
-            tx = rx + (rw // 3)
-
-        return point_in_rect(picture.display_x + tx, picture.display_y + ty, tw, th, x, y)
-
-    def test_center_start_drag(self, x, y):
-
-        rx, ry, rw, rh = self.get_display_rect()
-
-        return point_in_rect(picture.display_x + rx, picture.display_y + ry, rw, rh, x, y)
-        # border = self.corner_hot_area / 2
-        # if x < self.display_x + rx + border:
-        #     return False
-        # if y < self.display_y + ry + border:
-        #     return False
-        # if x > self.display_x + rx + rw - border:
-        #     return False
-        # if y > self.display_y + ry + rh - border:
-        #     return False
-        # return True
-
-    def apply_filters(self, im):
-
-        if self.sharpen:
-            im = im.filter(ImageFilter.UnsharpMask(radius=0.35, percent=150, threshold=0))
-
-        return im
-
-    def gen_thumbnails(self, hq=False):
-
-        # if self.rotation and not hq:
-        #     return
-
-        key = (self.source_image, self.gray, self.flip_hoz, self.flip_vert, self.rotation)
-        if self.source_image and self.thumb_cache_key == key:
-            im = self.thumb_cache_img
-        else:
-            self.thumb_cache_key = key
-
-            im = self.source_image
-            if not im:
-                return
-
-            if self.gray:
-                im = im.convert("L")
-                im = im.convert("RGB")
-
-            if self.flip_hoz:
-                im = im.transpose(method=Image.FLIP_LEFT_RIGHT)
-            if self.flip_vert:
-                im = im.transpose(method=Image.FLIP_TOP_BOTTOM)
-
-            if self.rotation:
-                im = im.rotate(self.rotation, expand=True, resample=Image.BICUBIC)
-
-            self.thumb_cache_img = im
-
-        if self.crop:
-            cr = im.crop((self.rec_x, self.rec_y, self.rec_x + self.rec_w, self.rec_y + self.rec_h))
-        else:
-            cr = im.copy()
-
-        cr.load()
-
-        for size in self.thumbs:
-            if not hq:
-                cr.thumbnail((size, size), Image.NEAREST)  # BILINEAR
-            else:
-                cr.thumbnail((size, size), Image.ANTIALIAS)
+        if self.exported is not None:
+            return
 
-            w, h = cr.size
+        from gi.repository import Notify
+        Notify.init(app_title)
+        self.exported = Notify.Notification.new(app_title, self.exported_text)
+        self.exported.add_action(
+            "action_click",
+            "Open output folder",
+            open_encode_out,
+            None
+        )
+        self.invalid_output = Notify.Notification.new(app_title, "Could not locate output folder!")
 
-            if "A" not in cr.getbands():
-                cr.putalpha(int(1 * 256.0))
+    def set_exported_text(self, text):
 
-            cr = self.apply_filters(cr)
+        self.exported_text = text
+        if self.exported is not None:
+            self.exported.update(app_title, text)
 
-            by = cr.tobytes("raw", "BGRa")
-            arr = bytearray(by)
-            self.thumb_surfaces[size] = cairo.ImageSurface.create_for_data(
-                arr, cairo.FORMAT_ARGB32, w, h
-            )
+    def show_exported(self):
 
+        self.setup()
+        self.exported.show()
 
-    def reload(self, keep_rect=False):
+    def show_invalid_output(self):
 
-        im = self.source_image.copy()
-        im.load()
+        self.setup()
+        self.invalid_output.show()
 
-        if self.flip_hoz:
-            im = im.transpose(method=Image.FLIP_LEFT_RIGHT)
-        if self.flip_vert:
-            im = im.transpose(method=Image.FLIP_TOP_BOTTOM)
+    def close(self):
 
-        if self.rotation:
-            im = im.rotate(self.rotation, expand=True, resample=Image.NEAREST) #, resample=0)
+        if self.exported is not None:
+            self.exported.close()
+            self.invalid_output.close()
 
-        w, h = im.size
-        self.source_w, self.source_h = w, h
-        self.display_w, self.display_h = w, h
-        self.display_x, self.display_y = 40, 40
 
-        b_w, b_h = self.bounds
+notices = Notices()
 
-        if b_h > 100 and b_w > 100 and b_h - 80 < h:
-            im.thumbnail((max(b_w - 320, 320), b_h - 80))
-            self.display_w, self.display_h = im.size
+# Check if a rectangle overlaps cairo clip extents (x1, y1, x2, y2)
+def rect_in_clip(clip, x, y, w, h):
+    return x < clip[2] and y < clip[3] and x + w > clip[0] and y + h > clip[1]
 
-        self.scale_factor = self.display_h / self.source_h
-        if not keep_rect:
-            self.rec_w = round(250 / self.scale_factor)
-            self.rec_h = self.rec_w
+class FileChooserWithImagePreview(Gtk.FileChooserNative):
+    resize_to = (256, 256)
 
-        if "A" not in im.getbands():
-            im.putalpha(int(1 * 256.0))
+    # Recent previews, shared between dialogs and keyed by path and mtime
+    preview_cache = collections.OrderedDict()
+    preview_cache_limit = 64
 
-        by = im.tobytes("raw", "BGRa")
-        arr = bytearray(by)
+    thumbnail_folder = os.path.join(GLib.get_user_cache_dir(), "thumbnails")
 
-        self.surface = cairo.ImageSurface.create_for_data(
-            arr, cairo.FORMAT_ARGB32, self.display_w, self.display_h
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+    
+        self.preview_widget = Gtk.Image()
+        self.set_preview_widget(self.preview_widget)
+        self.connect(
+            "update-preview",
+            self.update_preview,
+            self.preview_widget
         )
-        self.ready = True
-        self.confine()
 
-    def set_ratio(self):
-
-        if self.crop_ratio and self.crop_ratio != (1, 1):
-
-            if self.crop_ratio == (21, 9) and abs(self.rec_h - 1080) < 50:
-                self.rec_h = 1080
-                self.rec_w = 2560
-
-            elif self.crop_ratio == (16, 9) and abs(self.rec_h - 1080) < 50:
-                self.rec_h = 1080
-                self.rec_w = 1920
-
-            else:
-                a = self.rec_h // self.crop_ratio[1]
-                self.rec_w = a * self.crop_ratio[0]
-                self.rec_h = a * self.crop_ratio[1]
-
-    def confine(self):
-
-        if self.lock_ratio:
-            self.set_ratio()
-
-        # Confine mask rectangle to self
-        if self.rec_x + self.rec_w > self.source_w:
-            self.rec_x = self.source_w - self.rec_w
-        if self.rec_y + self.rec_h > self.source_h:
-            self.rec_y = self.source_h - self.rec_h
-
-        if self.rec_x < 0:
-            self.rec_x = 0
-        if self.rec_y < 0:
-            self.rec_y = 0
-
-        if self.rec_w > self.source_w:
-            self.rec_w = self.source_w
-            if self.lock_ratio:
-                if self.crop_ratio == (1, 1):
-                    self.rec_h = self.rec_w
-
-        if self.rec_h > self.source_h:
-            self.rec_h = self.source_h
-            if self.lock_ratio:
-                self.rec_w = self.rec_h
-
-    def load(self, path, bounds):
-
-        self.loaded_fullpath = path
-        self.file_name = os.path.splitext(os.path.basename(path))[0]
-        self.bounds = bounds
-        self.source_image = Image.open(path)
+        # Only the latest selection is waiting to be decoded, older ones are dropped
+        self.preview_filename = None
+        self.pending = None
+        self.working = False
+        self.lock = threading.Lock()
+    
+    def update_preview(self, dialog, preview_widget):
+        filename = self.get_preview_filename()
+        self.preview_filename = filename
 
-        self.exif = None
-        info = self.source_image.info
-        if "exif" in info:
-            self.exif = piexif.load(info["exif"])
+        try:
+            key = (filename, os.stat(filename).st_mtime)
+        except (OSError, TypeError):
+            self.set_preview_widget_active(False)
+            return
 
-        self.reload()
-        self.gen_thumbnails(hq=True)
+        pixbuf = self.preview_cache.get(key)
+        if pixbuf is None:
+            pixbuf = self.find_thumbnail(filename, key[1])
+            if pixbuf is not None:
+                self.cache_preview(key, pixbuf)
 
-    def get_display_rect_hw(self):
-        return round(self.rec_h + self.rec_w)
+        if pixbuf is not None:
+            self.preview_cache.move_to_end(key)
+            preview_widget.set_from_pixbuf(pixbuf)
+            self.set_preview_widget_active(True)
+            return
 
-    def get_display_rect(self):
+        # Not seen before, so decode it without holding up the dialog
+        with self.lock:
+            self.pending = key
+            if self.working:
+                return
+            self.working = True
 
-        return (round(self.rec_x * self.scale_factor),
-                round(self.rec_y * self.scale_factor),
-                round(self.rec_w * self.scale_factor),
-                round(self.rec_h * self.scale_factor))
+        thread = threading.Thread(target=self.preview_worker)
+        thread.daemon = True
+        thread.start()
 
-    def save_display_rect(self, x, y, w, h):
+    def find_thumbnail(self, filename, mtime):
 
-        self.rec_x = round(x / self.scale_factor)
-        self.rec_y = round(y / self.scale_factor)
-        self.rec_w = round(w / self.scale_factor)
-        self.rec_h = round(h / self.scale_factor)
+        # Thumbnails the file manager already made, see the freedesktop thumbnail spec
+        uri = GLib.filename_to_uri(os.path.abspath(filename))
+        name = hashlib.md5(uri.encode()).hexdigest() + ".png"
 
-    def export(self, path=None):
+        for size in ("large", "normal"):
+            try:
+                pixbuf = GdkPixbuf.Pixbuf.new_from_file(os.path.join(self.thumbnail_folder, size, name))
+            except GLib.Error:
+                continue
 
-        show_notice = True
-        if path is not None:
-            show_notice = False
-            base_folder = os.path.dirname(path)
-        else:
-            if self.export_setting == "pictures":
-                base_folder = self.pictures_folder
-            elif self.export_setting == "download":
-                base_folder = self.download_folder
-            elif self.export_setting == "overwrite":
-                base_folder = os.path.dirname(self.loaded_fullpath)
-                path = self.loaded_fullpath
-            else:
-                print("Export setting error")
-                return
+            # Skip thumbnails made before the file last changed
+            if pixbuf.get_option("tEXt::Thumb::MTime") == str(int(mtime)):
+                return pixbuf
 
-        print(f"Target folder is: {base_folder}")
+        return None
 
-        if not os.path.isdir(base_folder):
-            notify_invalid_output.show()
+    def cache_preview(self, key, pixbuf):
 
-        im = self.source_image
-        if not im:
-            return
+        self.preview_cache[key] = pixbuf
+        while len(self.preview_cache) > self.preview_cache_limit:
+            self.preview_cache.popitem(last=False)
 
-        if self.gray:
-            im = im.convert("L")
-            im = im.convert("RGB")
+    def preview_worker(self):
 
-        if self.flip_hoz:
-            im = im.transpose(method=Image.FLIP_LEFT_RIGHT)
-        if self.flip_vert:
-            im = im.transpose(method=Image.FLIP_TOP_BOTTOM)
+        while True:
+            with self.lock:
+                key = self.pending
+                self.pending = None
+                if key is None:
+                    self.working = False
+                    return
 
-        if self.rotation:
-            im = im.rotate(self.rotation, expand=True, resample=Image.BICUBIC)
+            try:
+                pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(key[0], *self.resize_to)
+            except GLib.Error:
+                pixbuf = None
 
-        cropped = False
+            GLib.idle_add(self.preview_ready, key, pixbuf)
 
-        if self.crop:
-            cr = im.crop((self.rec_x, self.rec_y, self.rec_x + self.rec_w, self.rec_y + self.rec_h))
-            cr.load()
-            cropped = True
-        else:
-            cr = im
+    def preview_ready(self, key, pixbuf):
 
-        old_size = cr.size
-        scaled = False
+        if pixbuf is not None:
+            self.cache_preview(key, pixbuf)
 
-        if self.export_constrain:
-            cr.thumbnail((self.export_constrain, self.export_constrain), Image.ANTIALIAS)
+        if key[0] == self.preview_filename:
+            if pixbuf is not None:
+                self.preview_widget.set_from_pixbuf(pixbuf)
+            self.set_preview_widget_active(pixbuf is not None)
 
-        if old_size != cr.size:
-            scaled = True
+        return False
 
-        cr = self.apply_filters(cr)
+picture = Picture()
+picture.download_folder = GLib.get_user_special_dir(GLib.UserDirectory.DIRECTORY_DOWNLOAD)
+picture.pictures_folder = GLib.get_user_special_dir(GLib.UserDirectory.DIRECTORY_PICTURES)
+if "output-mode" in config:
+    picture.export_setting = config["output-mode"]
 
-        png = self.png
+# Load thumbnail sizes from saved config
+if "thumbs" in config:
+    try:
+        thumbs = config["thumbs"]
+        for size in thumbs:
+            assert type(size) is int
+        picture.thumbs = thumbs
+    except:
+        print("Error reading config")
+        raise
 
-        overwrite = False
+if config.get("trace-file"):
+    tracer.enable(config["trace-file"])
 
-        if path is None:
+# Images too large for this are previewed from a reduced level and exported in tiles
+if config.get("memory-limit-mb"):
+    ImagePyramid.memory_limit = config["memory-limit-mb"] * 1024 * 1024
 
-            path = os.path.join(base_folder, self.file_name)
+# Display proxies of recently opened images
+cache_folder = os.path.join(GLib.get_user_cache_dir(), app_id, "proxies")
+proxy_cache = ProxyCache(cache_folder, config.get("cache-size-mb", 256) * 1024 * 1024)
 
-            if cropped:
-                path += "-cropped"
 
-            if scaled:
-                path += "-scaled"
+class ExportQueue:
 
-            ext = '.jpg'
-            if png:
-                ext = '.png'
+    def __init__(self, on_finished, threads=2):
 
-        else:
-            if path.lower().endswith(".png"):
-                png = True
-            else:
-                png = False
-            overwrite = True
+        self.on_finished = on_finished
+        self.jobs = []
+        self.queue = queue.Queue()
 
-        extra = ""
+        for i in range(threads):
+            thread = threading.Thread(target=self.worker)
+            thread.daemon = True
+            thread.start()
 
-        if not overwrite:
-            if os.path.isfile(path + ext):
-                i = 0
-                while True:
-                    i += 1
-                    extra = f"({str(i)})"
-                    if not os.path.isfile(path + extra + ext):
-                        break
+    def add(self, job):
 
-            path = path + extra + ext
+        self.jobs.append(job)
+        self.queue.put(job)
 
-        if png:
-            cr.save(path, "PNG")
-        else:
+    def cancel_all(self):
 
-            cr = cr.convert("RGB")
+        for job in self.jobs:
+            job.cancelled = True
 
-            if self.exif is not None and not self.discard_exif:
-                w, h = cr.size
-                self.exif["0th"][piexif.ImageIFD.XResolution] = (w, 1)
-                self.exif["0th"][piexif.ImageIFD.YResolution] = (h, 1)
-                exif_bytes = piexif.dump(self.exif)
-                cr.save(path, "JPEG", quality=95, exif=exif_bytes)
-            else:
+    def get_progress(self):
 
-                cr.save(path, "JPEG", quality=95)
+        if not self.jobs:
+            return 1
+        return sum(job.progress for job in self.jobs) / len(self.jobs)
 
-        self.last_saved_location = os.path.dirname(path)
+    def worker(self):
 
+        while True:
+            job = self.queue.get()
+            if not job.cancelled:
+                try:
+                    job.saved_path = job.picture.export(job.path, job=job)
+                except ExportCancelled:
+                    pass
+                except Exception as e:
+                    job.error = str(e)
+                    print(f"Export failed: {e}")
 
-        if show_notice:
-            notify.show()
+            GLib.idle_add(self.finished, job)
 
+    def finished(self, job):
 
-picture = Picture()
+        self.jobs.remove(job)
+        self.on_finished(job)
+        return False
 
 
 class SettingsDialog(Gtk.Dialog):
@@ -651,9 +406,9 @@ class SettingsDialog(Gtk.Dialog):
         self.show_all()
 
 
-class Window(Gtk.Window):
-    def __init__(self):
-        Gtk.Window.__init__(self, title=app_title)
+class Window(Gtk.ApplicationWindow):
+    def __init__(self, app):
+        Gtk.ApplicationWindow.__init__(self, application=app, title=app_title)
 
         GLib.set_application_name(app_title)
         GLib.set_prgname(app_id)
@@ -668,7 +423,8 @@ class Window(Gtk.Window):
         self.bl_cursor = Gdk.Cursor(Gdk.CursorType.BOTTOM_LEFT_CORNER)
         self.tl_cursor = Gdk.Cursor(Gdk.CursorType.TOP_LEFT_CORNER)
 
-        self.about = Gtk.AboutDialog()
+        # Built the first time it's opened
+        self.about = None
 
         self.rotate_reset_button = Gtk.Button(label="Reset rotation")
         #self.preview_circle_check = Gtk.CheckButton()
@@ -676,6 +432,48 @@ class Window(Gtk.Window):
 
         self.crop_mode_radios = []
 
+        # Incremented for every new load so that older loads still running get dropped
+        self.load_token = 0
+
+        # Images that the previous and next buttons step through
+        self.playlist = []
+        self.playlist_index = 0
+        self.prefetcher = Prefetcher(proxy_cache)
+
+        self.export_queue = ExportQueue(self.export_finished)
+        self.export_timer = None
+
+        self.rotate_timer = None
+        self.rotate_dragging = False
+
+        # Drag updates are applied once per frame. Motion events waiting for the next one
+        # are counted for the tracer.
+        self.frame_tick_id = None
+        self.motion_events = 0
+
+        # Milliseconds without changes before the HQ preview replaces the fast one
+        self.hq_preview_delay = 150
+        self.hq_preview_timer = None
+
+        # Bumped whenever a pending HQ preview is no longer wanted
+        self.hq_token = 0
+
+        # Where the crop rectangle was last drawn, so moving it repaints both places
+        self.drawn_crop_area = None
+
+        # Cached static parts of the canvas
+        self.background_layer = None
+        self.background_layer_size = (0, 0)
+        self.font_face = cairo.ToyFontFace("Sans")
+
+        # Smoothed timings for the trace overlay
+        self.last_frame_time = None
+        self.frame_time = 0
+        self.draw_time = 0
+
+        self.first_frame = True
+        self.startup_done = False
+
         self.setup_window()
 
         self.set_export_text()
@@ -684,18 +482,19 @@ class Window(Gtk.Window):
         setting = picture.export_setting
         if setting == "download":
             self.quick_export_button.set_tooltip_text("Export to Downloads folder")
-            notify.update(app_title, "Image file exported to Downloads.")
+            notices.set_exported_text("Image file exported to Downloads.")
         if setting == "pictures":
             self.quick_export_button.set_tooltip_text("Export to Pictures folder")
-            notify.update(app_title, "Image file exported to Pictures.")
+            notices.set_exported_text("Image file exported to Pictures.")
         if setting == "overwrite":
             self.quick_export_button.set_tooltip_text("Overwrite Image")
-            notify.update(app_title, "Image file overwritten.")
+            notices.set_exported_text("Image file overwritten.")
 
     def setup_window(self):
 
         draw = Gtk.DrawingArea()
         self.add(draw)
+        self.draw_area = draw
 
         draw.set_events(
             draw.get_events()
@@ -729,6 +528,7 @@ class Window(Gtk.Window):
         hb.set_show_close_button(True)
         hb.props.title = app_title
         self.set_titlebar(hb)
+        self.header_bar = hb
 
         button = Gtk.Button()
         button.set_tooltip_text("Open image file")
@@ -739,6 +539,31 @@ class Window(Gtk.Window):
         button.connect("clicked", self.open_file)
         # self.open_button = button
 
+        box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
+        box.get_style_context().add_class("linked")
+
+        button = Gtk.Button()
+        button.set_tooltip_text("Previous image (Page Up)")
+        icon = Gio.ThemedIcon(name="go-previous-symbolic")
+        image = Gtk.Image.new_from_gicon(icon, Gtk.IconSize.BUTTON)
+        button.add(image)
+        button.connect("clicked", self.previous_image)
+        button.set_sensitive(False)
+        box.add(button)
+        self.previous_button = button
+
+        button = Gtk.Button()
+        button.set_tooltip_text("Next image (Page Down)")
+        icon = Gio.ThemedIcon(name="go-next-symbolic")
+        image = Gtk.Image.new_from_gicon(icon, Gtk.IconSize.BUTTON)
+        button.add(image)
+        button.connect("clicked", self.next_image)
+        button.set_sensitive(False)
+        box.add(button)
+        self.next_button = button
+
+        hb.pack_start(box)
+
         button = Gtk.Button()
         #button.set_tooltip_text("Export to Downloads folder")
         icon = Gio.ThemedIcon(name="document-save-symbolic")
@@ -749,6 +574,18 @@ class Window(Gtk.Window):
         self.quick_export_button = button
 
 
+        hb.pack_end(button)
+
+        button = Gtk.Button()
+        button.set_tooltip_text("Cancel export")
+        icon = Gio.ThemedIcon(name="process-stop-symbolic")
+        image = Gtk.Image.new_from_gicon(icon, Gtk.IconSize.BUTTON)
+        button.add(image)
+        button.connect("clicked", self.cancel_exports)
+        button.set_no_show_all(True)
+        image.show()
+        self.cancel_export_button = button
+
         hb.pack_end(button)
         hb.pack_end(Gtk.Separator())
 
@@ -913,6 +750,8 @@ class Window(Gtk.Window):
         self.rot.set_draw_value(False)
         self.rot.set_has_origin(False)
         self.rot.connect("value-changed", self.rotate)
+        self.rot.connect("button-press-event", self.rotate_press)
+        self.rot.connect("button-release-event", self.rotate_release)
         vbox.pack_start(child=self.rot, expand=True, fill=False, padding=7)
         vbox.pack_start(child=self.rotate_reset_button, expand=True, fill=False, padding=7)
 
@@ -980,26 +819,98 @@ class Window(Gtk.Window):
         self.thumb_menu.show_all()
         self.thumb_remove_item = None
 
-        # About ---
-        self.about.set_authors(["Taiko2k"])
-        self.about.set_artists(["Tobias Bernard"])
-        self.about.set_copyright("Copyright 2019 Taiko2k captain.gxj@gmail.com")
-        self.about.set_license_type(Gtk.License(3))
-        self.about.set_website("https://github.com/taiko2k/" + app_title.lower())
-        self.about.set_website_label("Github")
-        self.about.set_destroy_with_parent(True)
-        self.about.set_version(version)
-        self.about.set_logo_icon_name(app_id)
-
-        for item in sys.argv:
-            if not item.endswith(".py") and os.path.isfile(item):
-                self.quick_export_button.set_sensitive(True)
-                picture.load(item, self.get_size())
-                self.discard_exif_button.set_sensitive(picture.exif and True)
-                break
-
         self.connect("destroy", self.on_exit)
 
+    def open_paths(self, paths):
+
+        # Several files are stepped through on their own, a single one brings its folder along
+        if len(paths) > 1:
+            self.playlist = paths
+            self.playlist_index = 0
+        else:
+            path = os.path.abspath(paths[0])
+            self.playlist = list_folder(path)
+            if path not in self.playlist:
+                self.playlist = [path]
+            self.playlist_index = self.playlist.index(path)
+
+        self.load_file(self.playlist[self.playlist_index])
+
+    def step_image(self, offset):
+
+        index = self.playlist_index + offset
+        if 0 <= index < len(self.playlist):
+            self.playlist_index = index
+            self.load_file(self.playlist[index])
+
+    def previous_image(self, button):
+        self.step_image(-1)
+
+    def next_image(self, button):
+        self.step_image(1)
+
+    def load_file(self, path):
+
+        self.load_token += 1
+        self.cancel_hq_preview()
+        thread = threading.Thread(target=self.load_worker, args=(path, self.load_token, self.get_size()))
+        thread.daemon = True
+        thread.start()
+
+        self.previous_button.set_sensitive(self.playlist_index > 0)
+        self.next_button.set_sensitive(self.playlist_index < len(self.playlist) - 1)
+        self.prefetcher.update(self.playlist, self.playlist_index, self.get_size())
+
+    @tracer.timed("load")
+    def load_worker(self, path, token, bounds):
+
+        try:
+            entry = self.prefetcher.take(path)
+            if entry is None:
+                entry = open_image(path, proxy_cache)
+            image, exif, pyramid = entry
+
+            # Decode a cheap low resolution version to show straight away
+            level = display_level(pyramid, bounds)
+            last_level = len(pyramid.levels) - 1
+            pyramid.get(max(level, min(pyramid.max_draft_level, last_level)))
+
+        except Exception as e:
+            print(f"Failed to load {path}: {e}")
+            return
+
+        if token != self.load_token:
+            return
+        GLib.idle_add(self.load_preview_ready, token, path, image, exif, pyramid)
+
+        # Then the level the display needs
+        pyramid.get(level)
+        if token != self.load_token:
+            return
+        GLib.idle_add(self.load_ready, token)
+
+    def load_preview_ready(self, token, path, image, exif, pyramid):
+
+        if token == self.load_token:
+            picture.bounds = self.get_size()
+            picture.set_source(path, image, exif, pyramid)
+            picture.thumb_surfaces.clear()
+            picture.reload(quick=True)
+            self.quick_export_button.set_sensitive(True)
+            self.discard_exif_button.set_sensitive(picture.exif and True)
+            self.queue_draw()
+
+        return False
+
+    def load_ready(self, token):
+
+        if token == self.load_token:
+            picture.reload(keep_rect=True)
+            self.queue_draw()
+            self.start_hq_preview()
+
+        return False
+
     def click_thumb_menu(self, item, reference):
 
         if reference == "circle":
@@ -1010,7 +921,7 @@ class Window(Gtk.Window):
             picture.thumb_surfaces.clear()
             # if not picture.thumbs:
             #     picture.thumbs.append(184)
-            picture.gen_thumbnails(hq=True)
+            self.update_preview()
         self.queue_draw()
 
     def on_exit(self, window):
@@ -1026,7 +937,7 @@ class Window(Gtk.Window):
         #picture.thumbs.append(184)
         self.add_preview_adjustment.set_value(184)
         picture.thumb_surfaces.clear()
-        picture.gen_thumbnails(hq=True)
+        self.update_preview()
         self.queue_draw()
 
     def add_preview(self, button):
@@ -1036,31 +947,28 @@ class Window(Gtk.Window):
             picture.thumbs.append(size)
             picture.thumbs.sort(reverse=True)
             picture.thumb_surfaces.clear()
-            picture.gen_thumbnails(hq=True)
+            self.update_preview()
             self.queue_draw()
 
     def toggle_flip_vert(self, button):
         picture.flip_vert ^= True
         if picture.source_image:
-            picture.reload(keep_rect=True)
+            picture.update_view()
+            self.update_preview()
             self.queue_draw()
-            picture.gen_thumbnails(hq=True)
 
     def toggle_flip_hoz(self, button):
         picture.flip_hoz ^= True
         if picture.source_image:
-            picture.reload(keep_rect=True)
+            picture.update_view()
+            self.update_preview()
             self.queue_draw()
-            picture.gen_thumbnails(hq=True)
 
     def rotate_reset(self, button):
 
         picture.rotation = 0
         self.rot.set_value(0)
-        if picture.source_image:
-            picture.reload(keep_rect=True)
-            self.queue_draw()
-            picture.gen_thumbnails(hq=True)
+        self.rotate_settle()
         self.rotate_reset_button.set_sensitive(False)
 
     def set_custom_resize(self, adjustment):
@@ -1073,9 +981,42 @@ class Window(Gtk.Window):
         picture.rotation = scale.get_value() * -1
         self.rotate_reset_button.set_sensitive(True)
         if picture.source_image:
+            picture.update_view()
+            picture.gen_thumbnails()
+            self.queue_draw()
+
+            # Keyboard and scroll changes have no release, so settle after a short pause instead
+            if self.rotate_timer is not None:
+                GLib.source_remove(self.rotate_timer)
+            self.rotate_timer = GLib.timeout_add(300, self.rotate_timeout)
+
+    def rotate_press(self, scale, event):
+
+        self.rotate_dragging = True
+
+    def rotate_release(self, scale, event):
+
+        self.rotate_dragging = False
+        self.rotate_settle()
+
+    def rotate_timeout(self):
+
+        self.rotate_timer = None
+        if not self.rotate_dragging:
+            self.rotate_settle()
+        return False
+
+    def rotate_settle(self):
+
+        # Rotation has stopped changing, so render the real pixels
+        if self.rotate_timer is not None:
+            GLib.source_remove(self.rotate_timer)
+            self.rotate_timer = None
+
+        if picture.source_image and picture.surface_key != picture.view_key():
             picture.reload(keep_rect=True)
+            self.update_preview()
             self.queue_draw()
-            #picture.gen_thumb_184(hq=True)
 
     def on_key_press_event(self, widget, event):
 
@@ -1088,23 +1029,25 @@ class Window(Gtk.Window):
 
         if event.keyval == Gdk.KEY_Right:
             picture.rec_x += 1
-            picture.gen_thumbnails(hq=True)
-            self.queue_draw()
+            self.update_preview()
 
         if event.keyval == Gdk.KEY_Left:
             picture.rec_x -= 1
-            picture.gen_thumbnails(hq=True)
-            self.queue_draw()
+            self.update_preview()
 
         if event.keyval == Gdk.KEY_Up:
             picture.rec_y -= 1
-            picture.gen_thumbnails(hq=True)
-            self.queue_draw()
+            self.update_preview()
 
         if event.keyval == Gdk.KEY_Down:
             picture.rec_y += 1
-            picture.gen_thumbnails(hq=True)
-            self.queue_draw()
+            self.update_preview()
+
+        if event.keyval == Gdk.KEY_Page_Up:
+            self.step_image(-1)
+
+        if event.keyval == Gdk.KEY_Page_Down:
+            self.step_image(1)
 
 
     def on_key_release_event(self, widget, event):
@@ -1114,6 +1057,19 @@ class Window(Gtk.Window):
             picture.drag_start_position = None
 
     def show_about(self, button):
+
+        if self.about is None:
+            self.about = Gtk.AboutDialog()
+            self.about.set_authors(["Taiko2k"])
+            self.about.set_artists(["Tobias Bernard"])
+            self.about.set_copyright("Copyright 2019 Taiko2k captain.gxj@gmail.com")
+            self.about.set_license_type(Gtk.License(3))
+            self.about.set_website("https://github.com/taiko2k/" + app_title.lower())
+            self.about.set_website_label("Github")
+            self.about.set_destroy_with_parent(True)
+            self.about.set_version(version)
+            self.about.set_logo_icon_name(app_id)
+
         self.about.run()
         self.about.hide()
 
@@ -1144,7 +1100,7 @@ class Window(Gtk.Window):
         dialog.destroy()
 
         if choice == Gtk.ResponseType.ACCEPT:
-            picture.export(filename)
+            self.queue_export(filename)
 
     def crop_switch(self, switch, param):
 
@@ -1157,7 +1113,7 @@ class Window(Gtk.Window):
             button.set_sensitive(picture.crop)
 
         self.confine()
-        picture.gen_thumbnails(hq=True)
+        self.update_preview()
         self.queue_draw()
 
 
@@ -1200,8 +1156,7 @@ class Window(Gtk.Window):
         #     picture.crop = False
 
         self.confine()
-        picture.gen_thumbnails(hq=True)
-        self.queue_draw()
+        self.update_preview()
 
     def toggle_menu_setting(self, button, name):
 
@@ -1244,12 +1199,51 @@ class Window(Gtk.Window):
             picture.export_constrain = int(self.custom_resize_adjustment.get_value())
 
 
-        picture.gen_thumbnails(hq=True)
-        self.queue_draw()
+        self.update_preview()
 
     def save(self, widget):
 
-        picture.export()
+        self.queue_export()
+
+    def queue_export(self, path=None):
+
+        if not picture.source_image:
+            return
+
+        self.export_queue.add(ExportJob(picture.snapshot(), path))
+        self.cancel_export_button.show()
+        if self.export_timer is None:
+            self.export_timer = GLib.timeout_add(100, self.update_export_progress)
+        self.update_export_progress()
+
+    def update_export_progress(self):
+
+        jobs = len(self.export_queue.jobs)
+        if not jobs:
+            self.header_bar.set_subtitle(None)
+            self.cancel_export_button.hide()
+            self.export_timer = None
+            return False
+
+        percent = round(self.export_queue.get_progress() * 100)
+        if jobs == 1:
+            self.header_bar.set_subtitle(f"Exporting... {percent}%")
+        else:
+            self.header_bar.set_subtitle(f"Exporting {jobs} images... {percent}%")
+        return True
+
+    def cancel_exports(self, button):
+
+        self.export_queue.cancel_all()
+
+    def export_finished(self, job):
+
+        if job.output_missing:
+            notices.show_invalid_output()
+        elif job.saved_path is not None:
+            picture.last_saved_location = job.picture.last_saved_location
+            if job.show_notice:
+                notices.show_exported()
 
     def open_file(self, widget):
 
@@ -1271,25 +1265,24 @@ class Window(Gtk.Window):
 
         if filename and choice == Gtk.ResponseType.ACCEPT:
             print("File selected: " + filename)
-            self.quick_export_button.set_sensitive(True)
-            picture.load(filename, self.get_size())
-            self.discard_exif_button.set_sensitive(picture.exif and True)
+            self.open_paths([filename])
 
     def drag_drop_file(self, widget, context, x, y, selection, target_type, timestamp):
 
         if target_type == TARGET_TYPE_URI_LIST:
             uris = selection.get_data().strip()
-            uri = uris.decode().splitlines()[0]
 
-            if not uri.startswith("file://"):
-                return
-            path = urllib.parse.unquote(uri[7:])
-            self.quick_export_button.set_sensitive(True)
-            if os.path.isfile(path):
-                picture.load(path, self.get_size())
-                self.discard_exif_button.set_sensitive(picture.exif and True)
+            paths = []
+            for uri in uris.decode().splitlines():
+                uri = uri.strip()
+                if not uri.startswith("file://"):
+                    continue
+                path = urllib.parse.unquote(uri[7:])
+                if os.path.isfile(path):
+                    paths.append(path)
 
-            self.queue_draw()
+            if paths:
+                self.open_paths(paths)
 
 
     def click(self, draw, event):
@@ -1313,7 +1306,7 @@ class Window(Gtk.Window):
                     picture.thumb_surfaces.clear()
                     if not picture.thumbs:
                         picture.thumbs.append(184)
-                    picture.gen_thumbnails(hq=True)
+                    self.update_preview()
                     self.queue_draw()
                     break
 
@@ -1361,9 +1354,123 @@ class Window(Gtk.Window):
             picture.dragging_br = False
             picture.dragging_bl = False
             picture.dragging_tr = False
+
+            # The HQ update below supersedes any frame still pending
+            if self.frame_tick_id is not None:
+                self.draw_area.remove_tick_callback(self.frame_tick_id)
+                self.frame_tick_id = None
+            self.motion_events = 0
+
+            # A JPEG crop that lines up with its MCUs is exported losslessly
+            picture.snap_to_mcu()
+
+            self.update_preview()
+
+    def update_preview(self):
+
+        # Show a fast preview now and replace it with an HQ one once changes stop coming
+        picture.gen_thumbnails()
+        self.queue_crop_draw()
+
+        self.cancel_hq_preview()
+        self.hq_preview_timer = GLib.timeout_add(self.hq_preview_delay, self.hq_preview)
+
+    def cancel_hq_preview(self):
+
+        self.hq_token += 1
+        if self.hq_preview_timer is not None:
+            GLib.source_remove(self.hq_preview_timer)
+            self.hq_preview_timer = None
+
+    def hq_preview(self):
+
+        self.hq_preview_timer = None
+        self.start_hq_preview()
+        return False
+
+    def start_hq_preview(self):
+
+        # HQ previews may want a larger level than is decoded yet, that's decoded in the
+        # background first so the window never waits for it
+        self.hq_token += 1
+        level = picture.hq_preview_level()
+        if level is not None and picture.pyramid.levels[level] is None:
+            thread = threading.Thread(target=self.hq_worker, args=(picture.pyramid, level, self.hq_token))
+            thread.daemon = True
+            thread.start()
+        else:
+            self.hq_ready(self.hq_token)
+
+    def hq_worker(self, pyramid, level, token):
+
+        try:
+            pyramid.get(level)
+        except Exception as e:
+            print(f"Failed to decode: {e}")
+            return
+
+        if token == self.hq_token:
+            GLib.idle_add(self.hq_ready, token)
+
+    def hq_ready(self, token):
+
+        if token == self.hq_token:
             picture.gen_thumbnails(hq=True)
+            self.draw_area.queue_draw_area(*self.preview_area())
 
-        self.queue_draw()
+        return False
+
+    def schedule_frame(self):
+
+        # Motion events can arrive much faster than the display refreshes, so only
+        # note that an update is needed and do the work on the next frame clock tick
+        self.cancel_hq_preview()
+        self.motion_events += 1
+        if self.frame_tick_id is None:
+            self.frame_tick_id = self.draw_area.add_tick_callback(self.frame_tick)
+
+    def frame_tick(self, widget, frame_clock):
+
+        self.frame_tick_id = None
+
+        # One of the events waiting gets this frame, the rest were merged into it
+        for i in range(self.motion_events):
+            tracer.count("motion_merged", i > 0)
+        self.motion_events = 0
+
+        picture.gen_thumbnails()
+        self.queue_crop_draw()
+        return False
+
+    def crop_area(self):
+
+        # Window area of the crop rectangle with its outline and the size label above it
+        if not picture.ready or not picture.crop:
+            return None
+
+        rx, ry, rw, rh = picture.get_display_rect()
+        x = picture.display_x + rx
+        y = picture.display_y + ry
+        return x - 2, y - 22, max(rw, 100) + 4, rh + 24
+
+    def preview_area(self):
+
+        # Window area of the preview strip in the bottom right, with its labels
+        w, h = self.get_size()
+        width = sum(size + 16 for size in picture.thumbs) + 16
+        height = max(picture.thumbs, default=0) + 16 + 24
+        return w - width, h - height, width, height
+
+    def queue_crop_draw(self):
+
+        # Only repaint where the crop rectangle was last drawn, where it is now and the
+        # previews, rather than the whole window
+        for area in (self.drawn_crop_area, self.crop_area(), self.preview_area()):
+            if area is not None:
+                self.draw_area.queue_draw_area(*area)
+
+        if tracer.overlay:
+            self.draw_area.queue_draw_area(8, 8, 200, 22)
 
     def mouse_leave(self, draw, event):
 
@@ -1541,8 +1648,7 @@ class Window(Gtk.Window):
 
             if picture.dragging_center or dragging_corners:
                 self.confine()
-                picture.gen_thumbnails()
-                self.queue_draw()
+                self.schedule_frame()
 
         else:
             picture.dragging_center = False
@@ -1568,31 +1674,19 @@ class Window(Gtk.Window):
             else:
                 gdk_window.set_cursor(self.arrow_cursor)
 
+    @tracer.timed("draw")
     def draw(self, wid, c):
 
+        draw_start = time.perf_counter()
         w, h = self.get_size()
 
-        # Draw background colour
-        c.set_source_rgb(background_color[0], background_color[1], background_color[2])
+        # Background colour and grid
+        c.set_source_surface(self.get_background_layer(c, w, h), 0, 0)
         c.paint()
-
-        # Draw background grid
-        c.set_source_rgb(0.3, 0.3, 0.3)
         c.set_line_width(1)
 
-        size = 8
-        for y in range(0, h + 20, 100):
-            y += 40
-            for x in range(0, w + 20, 100):
-                x += 40
-
-                c.move_to(x - size, y)
-                c.line_to(x + size, y)
-                c.stroke()
-
-                c.move_to(x, y - size)
-                c.line_to(x, y + size)
-                c.stroke()
+        # Only the damaged parts of the window need repainting
+        clip = c.clip_extents()
 
         # Draw image
         if picture.ready:
@@ -1602,28 +1696,35 @@ class Window(Gtk.Window):
             w = picture.display_w
             h = picture.display_h
 
-            # c.save()
-            # c.translate(0 + w // 2, 0 + h // 2)
-            # c.rotate(math.radians(picture.rotation))
-            # c.translate(w // 2 * -1, h // 2 * -1)
-            c.set_source_surface(picture.surface, x, y)
-            c.paint()
-            # c.restore()
+            image_damaged = rect_in_clip(clip, x, y, w, h)
+
+            if image_damaged and picture.surface_key == picture.view_key():
+                c.set_source_surface(picture.surface, x, y)
+                c.paint()
+            elif image_damaged:
+                # Rotation or flips are still being adjusted, transform the base image instead
+                base = picture.get_base_surface()
+                c.save()
+                c.translate(x + w / 2, y + h / 2)
+                c.rotate(math.radians(picture.rotation) * -1)
+                c.scale(-1 if picture.flip_hoz else 1, -1 if picture.flip_vert else 1)
+                c.set_source_surface(base, base.get_width() / -2, base.get_height() / -2)
+                c.paint()
+                c.restore()
 
             c.set_source_rgba(0, 0, 0, 0.8)
 
             if picture.crop:
                 rx, ry, rw, rh = picture.get_display_rect()
 
-                # Mask out rectangle
-                c.rectangle(x, y, rx, h)
-                c.fill()
-                c.rectangle(x + rx, y, w - rx, ry)
-                c.fill()
-                c.rectangle(x + rx + rw, y + ry, w - rx - rw, h - ry)
-                c.fill()
-                c.rectangle(x + rx, y + ry + rh, rw, h - ry - rh)
+                # Mask out everything but the rectangle, as one even-odd fill
+                c.set_fill_rule(cairo.FILL_RULE_EVEN_ODD)
+                c.rectangle(x, y, w, h)
+                c.rectangle(x + rx, y + ry, rw, rh)
                 c.fill()
+                c.set_fill_rule(cairo.FILL_RULE_WINDING)
+
+            if picture.crop and rect_in_clip(clip, *self.crop_area()):
 
                 # Draw mask rectangle outline
                 c.set_source_rgba(0.6, 0.6, 0.6, 1)
@@ -1639,7 +1740,7 @@ class Window(Gtk.Window):
                 c.line_to(x + rx + rw, y + ry + rh // 2)
                 c.stroke()
 
-                c.select_font_face("Sans")
+                c.set_font_face(self.font_face)
                 c.set_font_size(13)
                 c.move_to(x + rx, y + ry - 5)
 
@@ -1680,26 +1781,29 @@ class Window(Gtk.Window):
                 bottom = h - 16
 
                 for i, size in enumerate(picture.thumbs):
+                    if not rect_in_clip(clip, right - size, bottom - size - 24, size, size + 24):
+                        right -= size + 16
+                        continue
+
                     if size not in picture.thumb_surfaces:
-                        picture.gen_thumbnails(hq=True)
+                        # HQ if its level is decoded already, otherwise fast until it is
+                        if picture.pyramid.levels[picture.hq_preview_level()] is not None:
+                            picture.gen_thumbnails(hq=True)
+                        else:
+                            picture.gen_thumbnails()
+                            self.start_hq_preview()
 
 
                     if picture.circle:
-                        c.save()
-                        #c.arc(w - 200 + (184 // 2), h - 200 + (184 // 2), 184 // 2, 0, 2 * math.pi)
-                        c.arc(right - size // 2, bottom - size // 2, size // 2, 0, 2 * math.pi)
-                        c.clip()
-                        #c.set_source_surface(picture.surface184, w - 200, h - 200)
-                        c.set_source_surface(picture.thumb_surfaces[size], right - size, bottom - size)
+                        c.set_source_surface(picture.get_circle_surface(size), right - size, bottom - size)
                         c.paint()
-                        c.restore()
                     else:
                         #c.set_source_surface(picture.surface184, w - 200, h - 200)
                         c.set_source_surface(picture.thumb_surfaces[size], right - size, bottom - size)
                         c.paint()
 
                     if i == 0:
-                        c.select_font_face("Sans")
+                        c.set_font_face(self.font_face)
                         c.set_font_size(13)
                         c.move_to(right - size, bottom - (size + 5))
 
@@ -1714,10 +1818,122 @@ class Window(Gtk.Window):
 
                     right -= size + 16
 
+        self.drawn_crop_area = self.crop_area()
+
+        if tracer.overlay:
+            self.draw_overlay(c, draw_start)
+
+        if startup_timing and not self.startup_done:
+            self.startup_frame()
+
+    def startup_frame(self):
+
+        # With --startup-time, report the first frame and the first with the opened image
+        # on it, then quit
+        if self.first_frame:
+            self.first_frame = False
+            startup_mark("first frame")
+
+        if picture.ready:
+            startup_mark("first frame with image")
+        elif self.load_token:
+            return
+
+        self.startup_done = True
+        GLib.idle_add(self.close)
+
+    def get_background_layer(self, c, w, h):
+
+        # The background only changes with the window size, so it's drawn once into a
+        # surface like the window's own and painted from there
+        if self.background_layer is None or self.background_layer_size != (w, h):
+            self.background_layer = c.get_target().create_similar(cairo.CONTENT_COLOR, w, h)
+            self.background_layer_size = (w, h)
+
+            lc = cairo.Context(self.background_layer)
+            lc.set_source_rgb(background_color[0], background_color[1], background_color[2])
+            lc.paint()
+
+            # All the grid crosses go into one path
+            lc.set_source_rgb(0.3, 0.3, 0.3)
+            lc.set_line_width(1)
+
+            size = 8
+            for y in range(0, h + 20, 100):
+                y += 40
+                for x in range(0, w + 20, 100):
+                    x += 40
+
+                    lc.move_to(x - size, y)
+                    lc.line_to(x + size, y)
+                    lc.move_to(x, y - size)
+                    lc.line_to(x, y + size)
+
+            lc.stroke()
+
+        return self.background_layer
+
+    def draw_overlay(self, c, draw_start):
+
+        # Time since the last frame and how long this one took to draw, smoothed a little
+        now = time.perf_counter()
+        if self.last_frame_time is not None:
+            self.frame_time = self.frame_time * 0.8 + (now - self.last_frame_time) * 0.2
+        self.draw_time = self.draw_time * 0.8 + (now - draw_start) * 0.2
+        self.last_frame_time = now
+
+        c.select_font_face("Monospace")
+        c.set_font_size(12)
+        c.set_source_rgba(0, 0, 0, 0.6)
+        c.rectangle(8, 8, 200, 22)
+        c.fill()
+        c.move_to(14, 23)
+        c.set_source_rgba(0.9, 0.9, 0.4, 1)
+        c.show_text(f"frame {self.frame_time * 1000:5.1f} ms  draw {self.draw_time * 1000:5.1f} ms")
+
+
+class Application(Gtk.Application):
+
+    # Only one instance runs. Launching Avvie again hands its files over D-Bus to the
+    # running one, which opens them as if they had been dropped on the window.
+
+    def __init__(self):
+
+        flags = Gio.ApplicationFlags.HANDLES_OPEN
+
+        # Startup timing has to measure a fresh instance
+        if startup_timing:
+            flags |= Gio.ApplicationFlags.NON_UNIQUE
+
+        Gtk.Application.__init__(self, application_id=app_id, flags=flags)
+        self.window = None
+
+    def do_activate(self):
+
+        if self.window is None:
+            self.window = Window(self)
+            self.window.show_all()
+            startup_mark("window built")
+
+        self.window.present()
+
+    def do_open(self, files, n_files, hint):
+
+        self.activate()
+
+        paths = [file.get_path() for file in files]
+        paths = [path for path in paths if path and os.path.isfile(path)]
+        if paths:
+            self.window.open_paths(paths)
+
+    def do_shutdown(self):
+
+        notices.close()
+        Gtk.Application.do_shutdown(self)
+
+
+if __name__ == "__main__":
 
-win = Window()
-win.connect("destroy", Gtk.main_quit)
-win.show_all()
-Gtk.main()
-notify.close()
-notify_invalid_output.close()
+    # GApplication would reject options it doesn't know about
+    argv = [item for item in sys.argv if item != "--startup-time"]
+    sys.exit(Application().run(argv))